@@ -0,0 +1,3 @@
+# Benchmarks for the scripts of this repository. They work on synthetic data and are run as modules from the root of
+#  the repository, e.g. "python -m benchmarks.align" or "python -m benchmarks.tokenizer <ELAN files>".
+#  benchmarks.run times the whole pipeline on inputs made by benchmarks.synthetic and writes the results to JSON.
@@ -0,0 +1,65 @@
+import random
+import sys
+import time
+
+import elan
+
+# Compares elan.align() with the loop that extract_speech() and extract_data() used before: it popped intervals
+#  with no pair out of lists, which is quadratic on tiers with many stray intervals.
+#  Usage: python -m benchmarks.align [number of annotations] [share of stray intervals]
+
+
+def synthetic_tiers(size, stray_rate, seed=0):
+    """    A pair of tiers with `size` matching intervals and about size * stray_rate empty intervals with no pair  """
+    rng = random.Random(seed)
+    ru, de = list(), list()
+    time_ = 0
+    for idx in range(size):
+        time_ += rng.randint(1500, 6000)
+        if rng.random() < stray_rate:
+            rng.choice((ru, de)).append(elan.Annotation(time_ - 700, time_ - 600, None))
+        ru.append(elan.Annotation(time_, time_ + 1200, "Строка {}".format(idx)))
+        de.append(elan.Annotation(time_ + rng.randint(-50, 50), time_ + 1200, "Zeile {}".format(idx)))
+    return elan.Tier("Говорящий", "utterance", ru), elan.Tier("Sprecher-Spch", "utterance", de)
+
+
+def pop_align(ru_tier, de_tier, tolerance=elan.TOLERANCE):
+    """    The former list.pop-based loop, kept here as the reference  """
+    pairs = list()
+    aa_ru_all, aa_de_all = list(ru_tier.annotations), list(de_tier.annotations)
+    idx = 0
+    while idx < min(len(aa_ru_all), len(aa_de_all)):
+        aa_ru, aa_de = aa_ru_all[idx], aa_de_all[idx]
+        if abs(aa_ru.start - aa_de.start) > tolerance:
+            if aa_de.start < aa_ru.start:
+                aa_de_all.pop(idx)
+            else:
+                aa_ru_all.pop(idx)
+        else:
+            pairs.append((aa_ru, aa_de))
+            idx += 1
+    return pairs
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def main(size=50000, stray_rate=0.3):
+    ru_tier, de_tier = synthetic_tiers(size, stray_rate)
+    print("{} + {} annotations, {:.0%} stray intervals".format(len(ru_tier.annotations), len(de_tier.annotations),
+                                                                stray_rate))
+    pop_time, expected = timed(pop_align, ru_tier, de_tier)
+    align_time, (pairs, dropped) = timed(elan.align, ru_tier, de_tier)
+    if pairs != expected:
+        raise AssertionError("elan.align() pairs intervals differently from the reference loop")
+    print("list.pop loop: {:8.3f} s".format(pop_time))
+    print("elan.align:    {:8.3f} s   ({} pairs, {} dropped)".format(align_time, len(pairs), len(dropped)))
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    stray_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 0.3
+    main(size, stray_rate)
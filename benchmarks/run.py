@@ -0,0 +1,163 @@
+from contextlib import redirect_stdout
+import datetime
+import json
+import os
+import platform
+import shutil
+from subprocess import DEVNULL, CalledProcessError, check_output
+import sys
+import tempfile
+import time
+
+import cli
+import elan
+import process_video
+from benchmarks import synthetic
+
+# Times every stage of the pipeline on synthetic ELAN files and videos of several sizes and writes the results to a
+#  JSON file, so that two commits can be compared on the same machine:
+#   python -m benchmarks.run [--sizes 100,1000,10000] [--repeat 3] [--output bench_results.json]
+#   python -m benchmarks.run --compare <old results> <new results>
+# Every stage runs in a temporary directory with an empty ELAN cache, i.e. each of them parses its ELAN file anew, as
+#  on the first run over real data. Stages whose dependencies are missing (ffmpeg, joblib) are reported as
+#  skipped with the reason.
+SIZES = (100, 1000, 10000)  # utterances per ELAN file
+REPEAT = 3  # the best of that many runs is reported
+CUT_SAMPLE = 10  # fragments cut by the cut_video stage; cutting all of them would take hours at large sizes
+OUTPUT = "./bench_results.json"
+
+
+def commit():
+    try:
+        return check_output(['git', 'rev-parse', 'HEAD'], stdin=DEVNULL, stderr=DEVNULL).decode().strip()
+    except (OSError, CalledProcessError):
+        return None
+
+
+def fresh_cache():
+    shutil.rmtree(elan.CACHE_PATH, ignore_errors=True)
+
+
+def measure(function, repeat):
+    """
+    Runs a stage `repeat` times and returns its timings in seconds: the best wall clock time, the CPU time of this
+      process and of its children (ffmpeg) in the same run, and the wall clock time of every run.
+    """
+    runs = list()
+    for _ in range(repeat):
+        fresh_cache()
+        before_times, before = os.times(), time.perf_counter()
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            function()
+        wall, after_times = time.perf_counter() - before, os.times()
+        cpu = after_times.user + after_times.system - before_times.user - before_times.system
+        children_cpu = after_times.children_user + after_times.children_system \
+            - before_times.children_user - before_times.children_system
+        runs.append({"wall": round(wall, 6), "cpu": round(cpu, 3), "children_cpu": round(children_cpu, 3)})
+    best = min(runs, key=(lambda x: x["wall"]))
+    return dict(best, runs=[run["wall"] for run in runs])
+
+
+def stages(size):
+    """    Makes the inputs of one size in the current directory and returns [(name of a stage, function)]  """
+    names = synthetic.make_eaf("raw.eaf", size, ordered=False)
+    synthetic.make_metadata("raw.csv", names)
+    synthetic.make_eaf("Ep1.eaf", size)
+    slices = process_video.extract_speech(["Ep1.eaf"])["Ep1"]
+    sample = slices[:CUT_SAMPLE]
+    try:  # the video is made here, so that its encoding is not timed
+        synthetic.make_video("Ep1.mp4", max(line[1] for line in sample) // 1000 + 1)
+    except (OSError, CalledProcessError) as error:
+        print("No test video, cut_video will be skipped:", error)
+
+    def reshape():
+        import reshape_tiers  # needs joblib
+        reshape_tiers.main("raw.eaf", "raw.csv", "reshaped.eaf")
+
+    def cut():
+        if not os.path.exists("Ep1.mp4"):
+            raise FileNotFoundError("no test video")
+        process_video.already_created.clear()
+        process_video.make_subtitles("Ep1", sample)
+        for slice_ in sample:
+            process_video.cut_video("Ep1.mp4", "Ep1", slice_)
+
+    def check():
+        import check_tiers  # needs joblib
+        check_tiers.check("Ep1.eaf")
+
+    def vrt():
+        import make_vrt  # needs joblib
+        make_vrt.make_vrt_files("Ep1.eaf")
+
+    return [("reshape_tiers.main", reshape),
+            ("elan.parse", lambda: elan.load("Ep1.eaf", cache_path=None)),
+            ("check_tiers.check", check),
+            ("process_video.extract_speech", lambda: process_video.extract_speech(["Ep1.eaf"])),
+            ("process_video.make_subtitles", lambda: process_video.make_subtitles("Ep1", slices)),
+            ("process_video.make_subtitles episode", lambda: process_video.make_subtitles("Ep1", slices, "episode")),
+            ("process_video.cut_video x{}".format(CUT_SAMPLE), cut),
+            ("make_vrt.make_vrt_files", vrt)]
+
+
+def run(sizes=SIZES, repeat=REPEAT, output=OUTPUT):
+    results = list()
+    output = os.path.abspath(output)
+    cwd = os.getcwd()
+    for size in sizes:
+        with tempfile.TemporaryDirectory(prefix="bench-") as directory:
+            os.chdir(directory)
+            process_video.mkdir("OUT")
+            process_video.mkdir("Subtitles")
+            try:
+                for name, function in stages(size):
+                    result = {"size": size, "stage": name}
+                    try:
+                        result.update(measure(function, repeat))
+                        print("{:>6} {:<40} {:9.3f} s".format(size, name, result["wall"]), flush=True)
+                    except (ImportError, OSError, CalledProcessError) as error:
+                        result["skipped"] = "{}: {}".format(type(error).__name__, error)
+                        print("{:>6} {:<40} skipped ({})".format(size, name, result["skipped"]), flush=True)
+                    results.append(result)
+            finally:
+                os.chdir(cwd)
+
+    with open(output, 'w', encoding="utf-8") as report:
+        json.dump({"commit": commit(), "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                   "python": platform.python_version(), "machine": platform.platform(), "cpus": os.cpu_count(),
+                   "repeat": repeat, "results": results}, report, ensure_ascii=False, indent=1)
+    print("Results are written to", output)
+
+
+def compare(old_path, new_path):
+    """    Prints the wall clock times of two result files side by side  """
+    def load(path):
+        with open(path, encoding="utf-8") as report:
+            data = json.load(report)
+        return data, {(result["size"], result["stage"]): result.get("wall") for result in data["results"]}
+
+    (old_data, old), (new_data, new) = load(old_path), load(new_path)
+    print("{:>6} {:<40} {:>10} {:>10} {:>8}".format("size", "stage", str(old_data["commit"])[:10],
+                                                    str(new_data["commit"])[:10], "ratio"))
+    for key in sorted(set(old) | set(new)):
+        before, after = old.get(key), new.get(key)
+        ratio = "{:7.2f}x".format(before / after) if before and after else "-"
+        print("{:>6} {:<40} {:>10} {:>10} {:>8}".format(
+            key[0], key[1], "-" if before is None else "{:.3f}".format(before),
+            "-" if after is None else "{:.3f}".format(after), ratio))
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    if arguments and arguments[0] == "--compare":
+        if len(arguments) != 3:
+            raise process_video.ParseError("Provide two result files: --compare <old results> <new results>")
+        compare(arguments[1], arguments[2])
+    else:
+        sizes = [int(size) for size in cli.pop_option(arguments, "--sizes", ",".join(map(str, SIZES)))
+                 .split(",")]
+        repeat = int(cli.pop_option(arguments, "--repeat", REPEAT))
+        output = cli.pop_option(arguments, "--output", OUTPUT)
+        if arguments or repeat < 1:
+            raise process_video.ParseError("Unknown arguments: {}".format(' '.join(arguments)))
+        run(sizes, repeat, output)
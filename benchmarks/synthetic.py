@@ -0,0 +1,103 @@
+import csv
+import random
+from subprocess import DEVNULL, check_call
+from xml.etree import ElementTree as et
+
+# Synthetic inputs for the benchmarks: ELAN files of any size, the .csv metadata reshape_tiers.py needs and test videos.
+#  They imitate the structure of the real episodes, which cannot be shared: pairs of "-Spch" tiers with Russian and
+#  German lines, linguistic annotation tiers and empty intervals added by mistake.
+
+WORDS_RU = "да нет я ты он она мы вы они что это как где когда почему здесь там сейчас потом очень хорошо плохо " \
+           "знаю думаю говорю смотри слушай пойдём давай конечно может быть".split()
+WORDS_DE = "ja nein ich du er sie wir ihr was das wie wo wann warum hier dort jetzt dann sehr gut schlecht weiß " \
+           "denke sage schau hör gehen wir komm natürlich vielleicht".split()
+ANNOTATIONS = ["Frage", "Bitte", "Ironie", "Gruß", "Vorwurf", "Zustimmung"]
+
+
+def speaker_names(speakers):
+    """    Names of the Russian and German tiers of every speaker  """
+    return [("Говорящий {}".format(k), "Sprecher {}-Spch".format(k)) for k in range(1, speakers + 1)]
+
+
+def line(rng, words, end):
+    return ' '.join(rng.choice(words) for _ in range(rng.randint(1, 12))).capitalize() + end
+
+
+def make_eaf(path, utterances, speakers=4, stray_rate=0.1, annotation_rate=0.3, ordered=True, seed=0):
+    """
+    Writes an ELAN file with `utterances` lines spread over `speakers` speakers.
+    Every line is a pair of intervals in the speaker's Russian and German tiers. About stray_rate of the lines come
+      with an empty interval shortly before them, in one tier only, and about annotation_rate of the lines have a
+      linguistic annotation in the speaker's "-NVK" or " AA" tier.
+    With ordered=False tiers are written in a random order and with another linguistic type, as they are before
+      reshape_tiers.py has been run.
+    Returns the list of (Russian tier, German tier) names, see make_metadata().
+    """
+    rng = random.Random(seed)
+    names = speaker_names(speakers)
+    tiers = {name: list() for pair in names for name in pair}
+    annotation_tiers = {"{}{}".format(de[:-len("-Spch")], suffix): de for _, de in names for suffix in ("-NVK", " AA")}
+    tiers.update((name, list()) for name in annotation_tiers)
+
+    time_ = 0
+    last_end = {ru: 0 for ru, _ in names}  # intervals of a tier never overlap in ELAN
+    for _ in range(utterances):
+        time_ += rng.randint(500, 4000)
+        ru, de = rng.choice(names)
+        time_ = max(time_, last_end[ru] + 500)
+        end = time_ + rng.randint(700, 5000)
+        if rng.random() < stray_rate:
+            tiers[rng.choice((ru, de))].append((time_ - 400, time_ - 200, None))
+        punctuation = rng.choice(".?!…")
+        tiers[ru].append((time_, end, line(rng, WORDS_RU, punctuation)))
+        tiers[de].append((time_ + rng.randint(-30, 30), end, line(rng, WORDS_DE, punctuation)))
+        last_end[ru] = end
+        if rng.random() < annotation_rate:
+            tier = rng.choice([name for name, owner in annotation_tiers.items() if owner == de])
+            tiers[tier].append((time_ + rng.randint(-50, 50), end, rng.choice(ANNOTATIONS)))
+
+    document = et.Element("ANNOTATION_DOCUMENT", {"FORMAT": "3.0", "VERSION": "3.0"})
+    header = et.SubElement(document, "HEADER", {"MEDIA_FILE": "", "TIME_UNITS": "milliseconds"})
+    et.SubElement(header, "MEDIA_DESCRIPTOR", {"MEDIA_URL": "file:///synthetic.mp4", "MIME_TYPE": "video/mp4"})
+    time_order = et.SubElement(document, "TIME_ORDER")
+
+    order = [name for pair in names for name in pair] + list(annotation_tiers)
+    if not ordered:
+        rng.shuffle(order)
+    slot = annotation = 0
+    for name in order:
+        is_utterance = name not in annotation_tiers
+        tier = et.SubElement(document, "TIER", {
+            "LINGUISTIC_TYPE_REF": "utterance" if is_utterance and ordered else "default-lt", "TIER_ID": name})
+        for start, end, value in tiers[name]:
+            refs = list()
+            for time_value in (start, end):
+                slot += 1
+                et.SubElement(time_order, "TIME_SLOT", {"TIME_SLOT_ID": "ts{}".format(slot),
+                                                        "TIME_VALUE": str(time_value)})
+                refs.append("ts{}".format(slot))
+            annotation += 1
+            alignable = et.SubElement(et.SubElement(tier, "ANNOTATION"), "ALIGNABLE_ANNOTATION", {
+                "ANNOTATION_ID": "a{}".format(annotation), "TIME_SLOT_REF1": refs[0], "TIME_SLOT_REF2": refs[1]})
+            et.SubElement(alignable, "ANNOTATION_VALUE").text = value
+    et.SubElement(document, "LINGUISTIC_TYPE", {"GRAPHIC_REFERENCES": "false", "LINGUISTIC_TYPE_ID": "default-lt",
+                                                "TIME_ALIGNABLE": "true"})
+    if ordered:
+        et.SubElement(document, "LINGUISTIC_TYPE", {"GRAPHIC_REFERENCES": "false", "LINGUISTIC_TYPE_ID": "utterance",
+                                                    "TIME_ALIGNABLE": "true"})
+    et.ElementTree(document).write(path, encoding="UTF-8", xml_declaration=True)
+    return names
+
+
+def make_metadata(path, names):
+    """    Writes the .csv file with pairs of tier names that reshape_tiers.py puts in order  """
+    with open(path, 'w', newline='') as metadata:
+        csv.writer(metadata).writerows(names)
+
+
+def make_video(path, duration, size="320x240", rate=25):
+    """    Makes a test video of `duration` seconds with ffmpeg's testsrc picture and a sine tone  """
+    check_call(['ffmpeg', '-f', 'lavfi', '-i', 'testsrc=duration={}:size={}:rate={}'.format(duration, size, rate),
+                '-f', 'lavfi', '-i', 'sine=frequency=440:duration={}'.format(duration),
+                '-c:v', 'libx264', '-preset', 'ultrafast', '-g', str(rate * 2), '-c:a', 'aac', '-shortest',
+                path, '-y', '-loglevel', '24'], stdin=DEVNULL)
@@ -0,0 +1,91 @@
+from collections import Counter
+import difflib
+import os
+import sys
+import tempfile
+import time
+
+import corpus
+import tokenizer
+from benchmarks import synthetic
+
+# Compares the tokenizers of tokenizer.py on the Russian and German lines of ELAN files: their speed with and without
+#  the cache and, if NLTK and its punkt data are installed, how often the regex tokenizer agrees with NLTK and on what
+#  it disagrees most often. Without ELAN files the lines of a synthetic one are used (see benchmarks.synthetic).
+#  Usage: python -m benchmarks.tokenizer [ELAN files or directories]
+SYNTHETIC_SIZE = 20000
+EXAMPLES = 20  # most frequent disagreements shown
+
+
+def lines_of(paths):
+    efiles = list()
+    for path in paths:
+        if os.path.isdir(path):
+            efiles += sorted(file.path for file in os.scandir(path) if os.path.splitext(file.path)[1] == ".eaf")
+        else:
+            efiles.append(path)
+    lines = list()
+    for efile in efiles:
+        for row in corpus.utterances(efile):
+            lines.extend(row[5:7])  # Russian and German text
+    return lines
+
+
+def timed(tokenize, lines):
+    start = time.perf_counter()
+    for line in lines:
+        tokenize(line)
+    return time.perf_counter() - start
+
+
+def agreement(lines):
+    """    Prints the share of lines and of tokens the regex tokenizer splits as NLTK does, and the usual differences  """
+    differences = Counter()
+    same_lines = same_tokens = nltk_tokens = 0
+    for line in set(lines):
+        expected, found = tokenizer.nltk_tokenize(line), tokenizer.regex_tokenize(line)
+        nltk_tokens += len(expected)
+        if expected == found:
+            same_lines += 1
+            same_tokens += len(expected)
+            continue
+        matcher = difflib.SequenceMatcher(None, expected, found, autojunk=False)
+        same_tokens += sum(block.size for block in matcher.get_matching_blocks())
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag != "equal":
+                differences[' '.join(expected[i1:i2]), ' '.join(found[j1:j2])] += 1
+    distinct = len(set(lines))
+    print("Agreement with NLTK: {:.2%} of {} distinct lines, {:.2%} of {} tokens".format(
+        same_lines / distinct, distinct, same_tokens / max(nltk_tokens, 1), nltk_tokens))
+    for (expected, found), count in differences.most_common(EXAMPLES):
+        print("{:>8}  nltk: {:<30} regex: {}".format(count, expected, found))
+
+
+def main(paths):
+    if paths:
+        lines = lines_of(paths)
+    else:
+        with tempfile.TemporaryDirectory(prefix="bench-") as directory:
+            path = os.path.join(directory, "synthetic.eaf")
+            synthetic.make_eaf(path, SYNTHETIC_SIZE)
+            lines = lines_of([path])
+    print("{} lines, {} distinct".format(len(lines), len(set(lines))))
+
+    names = ["regex"]
+    try:
+        tokenizer.nltk_tokenize("Ja.")
+        names.append("nltk")
+    except (ImportError, LookupError) as error:  # NLTK or its punkt data are not installed
+        print("NLTK is not available, only the regex tokenizer is measured:", type(error).__name__)
+    for name in names:
+        start = time.perf_counter()
+        tokenizer.get(name, 0)("Ja.")
+        first_call = time.perf_counter() - start  # the import of NLTK and the loading of its data
+        print("{:<6} first call {:8.3f} s   no cache {:8.3f} s   cache {:8.3f} s".format(
+            name, first_call, timed(tokenizer.get(name, 0), lines), timed(tokenizer.get(name), lines)))
+    if "nltk" in names:
+        agreement(lines)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
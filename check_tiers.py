@@ -1,3 +1,4 @@
+import json
 import os
 import re
 from subprocess import DEVNULL, check_call
@@ -5,8 +6,15 @@ import sys
 import datetime as dt
 from xml.etree import ElementTree as et
 
+from joblib import Parallel, delayed
+
+import cli
+import elan
+import files
+
 
 LINGUISTIC_TYPE_REF = {"utterance"}
+REPORT_PATH = "./check_report.json"
 
 
 class ParseError(Exception):
@@ -17,64 +25,132 @@ class ParseError(Exception):
         super().__init__(self.message)
 
 
-def check(efile):
-    root = et.parse(efile).getroot()
-
-    time_slots = dict()
-    for ts in root.findall('.//TIME_ORDER/TIME_SLOT'):
-        if ts.get('TIME_VALUE') is not None:
-            time_slots[ts.get('TIME_SLOT_ID')] = int(ts.get('TIME_VALUE'))
-
-    tiers = [t for t in root.findall('TIER') if t.get("LINGUISTIC_TYPE_REF") in LINGUISTIC_TYPE_REF]
-    tier_number = 0  # each (2n)th tier is the translation of (2n-1)th tier (note that index [1] points to tier 2)
-
-    flawless = True
-    while tier_number < len(tiers):
-        tier1, tier2 = tiers[tier_number], tiers[tier_number + 1]   # parsing tiers in pairs
-
-        aa1, aa2 = tier1.findall('.//ALIGNABLE_ANNOTATION'), tier2.findall('.//ALIGNABLE_ANNOTATION')
-
-        for aa1, aa2 in zip(aa1, aa2):
-            start1, end1 = time_slots[aa1.get('TIME_SLOT_REF1')], time_slots[aa1.get('TIME_SLOT_REF2')]
-            start2, end2 = time_slots[aa1.get('TIME_SLOT_REF1')], time_slots[aa1.get('TIME_SLOT_REF2')]
-            start1, end1 = dt.timedelta(milliseconds=start1), dt.timedelta(milliseconds=end1)
-            start2, end2 = dt.timedelta(milliseconds=start2), dt.timedelta(milliseconds=end2)
-            text1 = aa1.find("ANNOTATION_VALUE").text
-            text2 = aa2.find("ANNOTATION_VALUE").text
-            if text1 is None:  # no translation for one of the tiers
-                flawless = False
-                print("Speaker:", tier1.get("TIER_ID"),
-                      "\t Empty field:", text1, " | ", text2,
-                      "\t Located between", start1, "and", end1)
-            elif text2 is None:
-                flawless = False
-                print("Speaker:", tier2.get("TIER_ID"),
-                      "\t Empty field:", text1, " | ", text2,
-                      "\t Located between", start2, "and", end2)
-        tier_number += 2
-
-    if flawless:
+def interval(kind, tier, aa, **details):
+    """    A problem with one interval of a tier, see validate()  """
+    return dict({"type": kind, "tier": tier.tier_id, "start": aa.start, "end": aa.end}, **details)
+
+
+def validate(efile, tolerance=elan.TOLERANCE):
+    """
+    Checks the paired tiers of an ELAN file and returns a report {"file": ..., "problems": [...]}. Every problem is a
+      dict with its "type":
+        "error"       the file cannot be read or a tier has no pair ("message")
+        "length"      paired tiers have different numbers of intervals ("tier", "pair", "lengths")
+        "empty"       an interval has no text ("tier", "start", "end")
+        "misaligned"  no interval of the paired tier starts within `tolerance` ms of an interval with text, see
+                      elan.align() ("tier", "start", "end", "value")
+        "overlap"     an interval starts before the previous interval of its tier ends ("tier", "start", "end",
+                      "previous_end")
+    Times are in milliseconds. Each tier is walked once and valid intervals cost a comparison or two.
+    """
+    try:
+        pairs = elan.load(efile).pairs(LINGUISTIC_TYPE_REF)  # each (2n)th tier is the translation of (2n-1)th
+    except (OSError, ValueError, et.ParseError, elan.ParseError) as error:
+        return {"file": efile, "problems": [{"type": "error", "message": str(error)}]}
+
+    problems = list()
+    for tier1, tier2 in pairs:
+        if len(tier1.annotations) != len(tier2.annotations):
+            problems.append({"type": "length", "tier": tier1.tier_id, "pair": tier2.tier_id,
+                             "lengths": [len(tier1.annotations), len(tier2.annotations)]})
+        for tier in (tier1, tier2):
+            previous_end = None
+            for aa in tier.annotations:
+                if aa.value is None or not aa.value.strip():
+                    problems.append(interval("empty", tier, aa))
+                if previous_end is not None and aa.start < previous_end:
+                    problems.append(interval("overlap", tier, aa, previous_end=previous_end))
+                    previous_end = max(previous_end, aa.end)
+                else:
+                    previous_end = aa.end
+        for tier, aa in elan.align(tier1, tier2, tolerance)[1]:
+            if aa.value is not None and aa.value.strip():  # empty ones are reported above
+                problems.append(interval("misaligned", tier, aa, value=aa.value))
+    problems.sort(key=(lambda x: x.get("start", -1)))
+    return {"file": efile, "problems": problems}
+
+
+def print_report(report, tolerance=elan.TOLERANCE):
+    """    Prints the problems of a file found by validate() for a human  """
+    def time_(milliseconds):
+        return dt.timedelta(milliseconds=milliseconds)
+
+    for problem in report["problems"]:
+        kind = problem["type"]
+        if kind == "error":
+            print("Error:", problem["message"])
+        elif kind == "length":
+            print("Tiers", problem["tier"], "and", problem["pair"], "have different numbers of intervals:",
+                  *problem["lengths"])
+        else:
+            location = "\t Located between {} and {}".format(time_(problem["start"]), time_(problem["end"]))
+            if kind == "empty":
+                print("Speaker:", problem["tier"], "\t Empty field", location)
+            elif kind == "misaligned":
+                print("Speaker:", problem["tier"], "\t No pair within {} ms:".format(tolerance), problem["value"],
+                      location)
+            else:
+                print("Speaker:", problem["tier"], "\t Overlaps an interval ending at",
+                      time_(problem["previous_end"]), location)
+    if not report["problems"]:
         print("File seems to have no errors in intervals.")
 
 
-def main():
-    if len(sys.argv) < 2:
-        raise ParseError("Provide the path to separate ELAN files or a directory as command line arguments")
-    efiles = list()
-    for arg in sys.argv[1:]:
+def check(efile, tolerance=elan.TOLERANCE):
+    """    Checks an ELAN file and prints its problems, see validate(). Returns the report  """
+    report = validate(efile, tolerance)
+    print_report(report, tolerance)
+    return report
+
+
+def main(paths, jobs=os.cpu_count(), report_path=REPORT_PATH, tolerance=elan.TOLERANCE):
+    """
+    Checks ELAN files and directories with ELAN files given in paths, `jobs` files at a time in worker processes.
+    Problems are printed and written to report_path as JSON:
+        {"tolerance": ..., "files": ..., "flawed": ..., "problems": ..., "missing": [paths that do not exist],
+         "reports": [reports of validate()]}
+    Returns the number of files with problems plus the number of paths that do not exist. Raises ParseError if no
+      ELAN file is found at all, as there would be nothing to check.
+    """
+    efiles, missing = list(), list()
+    for arg in paths:
         if os.path.exists(arg) is False:
             print("Location does not exist:", arg)
+            missing.append(arg)
             continue
         elif os.path.isdir(arg):
             efiles += [file.path for file in os.scandir(arg) if os.path.splitext(file.path)[1] == ".eaf"]
         elif os.path.splitext(os.path.split(arg)[1])[1] == ".eaf":
             efiles.append(arg)
-
-    for efile in efiles:
-        print("Checking ", efile)
-        check(efile)
+    efiles = sorted({os.path.realpath(efile): efile for efile in efiles}.values())  # the same file given twice
+    if not efiles:
+        raise ParseError("No ELAN files found in: {}".format(' '.join(paths)))
+
+    reports = Parallel(n_jobs=max(1, min(jobs, len(efiles))))(delayed(validate)(efile, tolerance) for efile in efiles)
+    for report in reports:
+        print("Checking ", report["file"])
+        print_report(report, tolerance)
         print('*'*30)
 
+    flawed = sum(1 for report in reports if report["problems"])
+    with files.replacing(report_path) as output:
+        json.dump({"tolerance": tolerance, "files": len(reports), "flawed": flawed,
+                   "problems": sum(len(report["problems"]) for report in reports), "missing": missing,
+                   "reports": reports},
+                  output, ensure_ascii=False, indent=1)
+    print("{} of {} files have problems, see {}".format(flawed, len(reports), report_path))
+    return flawed + len(missing)
+
 
 if __name__ == '__main__':
-    main()
+    argv = sys.argv[1:]
+    jobs = int(cli.pop_option(argv, "--jobs", os.cpu_count()))
+    report_path = cli.pop_option(argv, "--report", REPORT_PATH)
+    tolerance = int(cli.pop_option(argv, "--tolerance", elan.TOLERANCE))
+    if len(argv) < 1 or jobs < 1:
+        raise ParseError("Provide the path to separate ELAN files or a directory as command line arguments\n"
+                         "Options: --jobs N  number of files to check at once (default: number of CPUs)\n"
+                         "         --report FILE  where to write the JSON report (default: {})\n"
+                         "         --tolerance MS  how far apart paired intervals may start (default: {})".format(
+                             REPORT_PATH, elan.TOLERANCE))
+    sys.exit(1 if main(argv, jobs, report_path, tolerance) else 0)
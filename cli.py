@@ -0,0 +1,27 @@
+# Command line helpers shared by the scripts, which read their options from sys.argv by hand.
+
+
+class ParseError(Exception):
+    """    The Exception class to use in case the command line is incorrect  """
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+def pop_option(argv, option, default=None):
+    """
+    Removes an option and its value from a list of command line arguments and returns the value.
+    Both "--option value" and "--option=value" forms are accepted. If the option is absent, default is returned.
+    """
+    for idx, arg in enumerate(argv):
+        if arg == option:
+            if idx + 1 == len(argv):
+                raise ParseError("Option {} requires a value.".format(option))
+            value = argv[idx + 1]
+            del argv[idx:idx + 2]
+            return value
+        elif arg.startswith(option + "="):
+            del argv[idx]
+            return arg[len(option) + 1:]
+    return default
@@ -0,0 +1,177 @@
+import hashlib
+import os
+import re
+import sqlite3
+import sys
+
+import cli
+import elan
+
+# The lines of all ELAN files in one SQLite database, so that they can be searched without cutting or tokenizing the
+#  whole corpus. Every line is a row of "utterances"; the full-text index "utterances_fts" (FTS5) covers the Russian
+#  and German text, the annotations and the names of the speaker's tiers. An ELAN file is indexed again only if its
+#  contents have changed. Bump DB_VERSION whenever the schema changes: the database is then rebuilt.
+DB_PATH = "./corpus.sqlite"
+DB_VERSION = 1
+LINGUISTIC_TYPE_REF = {"utterance"}
+
+SCHEMA = """
+CREATE TABLE files (episode TEXT PRIMARY KEY, path TEXT NOT NULL, digest TEXT NOT NULL);
+CREATE TABLE utterances (
+    id INTEGER PRIMARY KEY,
+    episode TEXT NOT NULL,
+    line INTEGER NOT NULL,  -- the id of the line in fragment names, see process_video.iter_speech()
+    speaker TEXT NOT NULL,  -- the Russian tier
+    speaker_de TEXT NOT NULL,  -- the German tier
+    start INTEGER NOT NULL,
+    "end" INTEGER NOT NULL,
+    ru TEXT NOT NULL,
+    de TEXT NOT NULL,
+    annotations TEXT NOT NULL  -- "<annotation tier>: <value>" per line
+);
+CREATE INDEX utterances_episode ON utterances (episode, line);
+CREATE INDEX utterances_speaker ON utterances (speaker);
+CREATE VIRTUAL TABLE utterances_fts USING fts5(
+    ru, de, annotations, speaker, speaker_de, content='utterances', content_rowid='id');
+CREATE TRIGGER utterances_insert AFTER INSERT ON utterances BEGIN
+    INSERT INTO utterances_fts (rowid, ru, de, annotations, speaker, speaker_de)
+    VALUES (new.id, new.ru, new.de, new.annotations, new.speaker, new.speaker_de);
+END;
+CREATE TRIGGER utterances_delete AFTER DELETE ON utterances BEGIN
+    INSERT INTO utterances_fts (utterances_fts, rowid, ru, de, annotations, speaker, speaker_de)
+    VALUES ('delete', old.id, old.ru, old.de, old.annotations, old.speaker, old.speaker_de);
+END;
+"""
+
+
+class ParseError(Exception):
+    """    The Exception class to use in case something is incorrect  """
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+def connect(db_path=DB_PATH):
+    """    Opens the database and creates (or, after a change of DB_VERSION, recreates) its tables  """
+    connection = sqlite3.connect(db_path)
+    if connection.execute("PRAGMA user_version").fetchone()[0] != DB_VERSION:
+        for kind, name in connection.execute(
+                "SELECT type, name FROM sqlite_master WHERE type IN ('table', 'trigger') AND name NOT LIKE 'sqlite_%' "
+                "AND name NOT LIKE 'utterances_fts_%'").fetchall():
+            connection.execute("DROP {} IF EXISTS \"{}\"".format(kind.upper(), name))
+        connection.executescript(SCHEMA)
+        connection.execute("PRAGMA user_version = {}".format(DB_VERSION))
+        connection.commit()
+    return connection
+
+
+def utterances(efile, tolerance=elan.TOLERANCE):
+    """
+    The lines of an ELAN file as lists [line, speaker, speaker_de, start, end, ru, de, annotations]. Lines are paired
+      and numbered exactly as process_video.iter_speech() does it, so that `line` is the id in the fragment names.
+      Annotations are found the way make_vrt.extract_data() finds them.
+    """
+    document = elan.load(efile)
+    annotation_tiers = document.tiers_by_suffix(elan.ANNOTATION_REGEX)
+    rows = list()
+    for ru_tier, de_tier in document.speech_pairs(LINGUISTIC_TYPE_REF):
+        tiers = annotation_tiers.get(re.sub("-Spch", '', de_tier.tier_id), list())
+        for aa_ru, aa_de in elan.align(ru_tier, de_tier, tolerance)[0]:
+            annotations = ["{}: {}".format(tier.tier_id, an.value) for tier in tiers
+                           for an in tier.starting_near(aa_de.start, elan.ANNOTATION_TOLERANCE) if an.value is not None]
+            rows.append([ru_tier.tier_id, de_tier.tier_id, aa_ru.start, aa_ru.end, str(aa_ru.value), str(aa_de.value),
+                         '\n'.join(annotations)])
+    rows.sort(key=(lambda x: x[3]))  # chronologically by the end, as in process_video.iter_speech()
+    return [[id_] + row for id_, row in enumerate(rows, start=1)]
+
+
+def index(efiles, db_path=DB_PATH, tolerance=elan.TOLERANCE):
+    """
+    Puts the lines of ELAN files into the database. Files whose contents have not changed since they were indexed are
+      skipped. Returns the number of files indexed anew.
+    """
+    connection = connect(db_path)
+    indexed = 0
+    try:
+        known = dict(connection.execute("SELECT episode, digest FROM files"))
+        for efile in efiles:
+            episode, extension = os.path.splitext(os.path.split(efile)[1])
+            if extension != ".eaf":
+                continue
+            with open(efile, 'rb') as source:
+                digest = hashlib.sha1(source.read()).hexdigest()
+            if known.get(episode) == digest:
+                continue
+            rows = utterances(efile, tolerance)
+            with connection:  # one transaction per file: a file is either indexed completely or not at all
+                connection.execute("DELETE FROM utterances WHERE episode = ?", (episode,))
+                connection.executemany(
+                    "INSERT INTO utterances (episode, line, speaker, speaker_de, start, \"end\", ru, de, annotations) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [[episode] + row for row in rows])
+                connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (episode, efile, digest))
+            print("Indexed {}: {} lines".format(efile, len(rows)))
+            indexed += 1
+    finally:
+        connection.close()
+    return indexed
+
+
+def search(query=None, speaker=None, episodes=None, db_path=DB_PATH):
+    """
+    Finds lines by a full-text query in FTS5 syntax (e.g. 'Haus', 'ru:дом', 'annotations:NVK', '"guten Tag"'),
+      by the name of the speaker's Russian or German tier, and/or within some episodes.
+    Returns a list of dicts with the columns of "utterances", ordered by episode and time.
+    """
+    conditions, parameters = list(), list()
+    if query:
+        conditions.append("id IN (SELECT rowid FROM utterances_fts WHERE utterances_fts MATCH ?)")
+        parameters.append(query)
+    if speaker:
+        conditions.append("(speaker = ? OR speaker_de = ?)")
+        parameters.extend([speaker, speaker])
+    if episodes is not None:
+        episodes = list(episodes)
+        conditions.append("episode IN ({})".format(', '.join('?' * len(episodes))))
+        parameters.extend(episodes)
+    connection = connect(db_path)
+    connection.row_factory = sqlite3.Row
+    try:
+        rows = connection.execute("SELECT * FROM utterances {} ORDER BY episode, start".format(
+            "WHERE " + " AND ".join(conditions) if conditions else ''), parameters).fetchall()
+    except sqlite3.OperationalError as error:  # a query with a syntax error
+        raise ParseError("Cannot search for {}: {}".format(query, error))
+    finally:
+        connection.close()
+    return [dict(row) for row in rows]
+
+
+def matching_lines(rows):
+    """    {episode: set of line ids} of the rows found by search(), see process_video.main()  """
+    result = dict()
+    for row in rows:
+        result.setdefault(row["episode"], set()).add(row["line"])
+    return result
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    db_path = cli.pop_option(argv, "--db", DB_PATH)
+    speaker = cli.pop_option(argv, "--speaker")
+    if len(argv) >= 2 and argv[0] == "index":
+        efiles = list()
+        for path in argv[1:]:
+            if os.path.isdir(path):
+                efiles += [file.path for file in os.scandir(path) if os.path.splitext(file.path)[1] == ".eaf"]
+            else:
+                efiles.append(path)
+        print("{} files indexed anew".format(index(sorted(efiles), db_path)))
+    elif len(argv) in (1, 2) and argv[0] == "search" and (len(argv) == 2 or speaker):
+        for row in search(argv[1] if len(argv) == 2 else None, speaker, db_path=db_path):
+            print("{episode}\t{line}\t{speaker}\t{start}-{end}\t{ru} | {de}".format(**row))
+    else:
+        raise ParseError("Provide arguments as follows:\n"
+                         "$... corpus.py index <ELAN files or directories>\n"
+                         "$... corpus.py search <query> [--speaker TIER]\n"
+                         "Options: --db FILE  the database (default: {})\n"
+                         "Queries are in the FTS5 syntax, e.g. 'Haus', 'ru:дом', 'annotations:NVK'".format(DB_PATH))
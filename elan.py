@@ -0,0 +1,184 @@
+import hashlib
+import os
+import pickle
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+from xml.etree import ElementTree as et
+
+import files
+
+# ELAN files are parsed once into the compact representation below and cached on disk, so that check_tiers.py,
+#  process_video.py and make_vrt.py do not have to parse the same XML again. The cache is keyed by the contents of a
+#  file, an edited file is therefore parsed anew. Bump CACHE_VERSION whenever the classes below change.
+CACHE_PATH = "./.elan_cache"
+CACHE_VERSION = 1
+TOLERANCE = 100  # milliseconds; paired intervals of two tiers may start this far apart
+# Names of tiers with linguistic annotations end with these suffixes; add new ones here. An annotation belongs to the
+#  line of the speaker whose German tier has the same name ("Junge-NVK" to "Junge-Spch") that starts less than
+#  ANNOTATION_TOLERANCE ms from it.
+ANNOTATION_REGEX = r"([ -]NVK|[ -]AA|[ -]Illok\.)$"
+ANNOTATION_TOLERANCE = 100
+
+
+class ParseError(Exception):
+    """    The Exception class to use in case something is incorrect  """
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+class Annotation:
+    """    An interval of a tier: start and end in milliseconds and the text, which is None for empty intervals  """
+    __slots__ = ("start", "end", "value")
+
+    def __init__(self, start, end, value):
+        self.start = start
+        self.end = end
+        self.value = value
+
+
+class Tier:
+    """
+    A tier with its annotations ordered by start time. starts is an array of the same start times, so that
+      intervals can be looked up with bisect.
+    """
+    __slots__ = ("tier_id", "linguistic_type", "annotations", "starts")
+
+    def __init__(self, tier_id, linguistic_type, annotations):
+        self.tier_id = tier_id
+        self.linguistic_type = linguistic_type
+        self.annotations = sorted(annotations, key=(lambda x: x.start))
+        self.starts = array('q', [annotation.start for annotation in self.annotations])
+
+    def starting_near(self, time, distance):
+        """    Annotations that start less than `distance` ms before or after `time`, found by binary search  """
+        return self.annotations[bisect_right(self.starts, time - distance):bisect_left(self.starts, time + distance)]
+
+
+class Document:
+    """    Tiers of an ELAN file in the order they have in the file  """
+    __slots__ = ("tiers",)
+
+    def __init__(self, tiers):
+        self.tiers = tiers
+
+    def tiers_of_type(self, linguistic_types):
+        return [tier for tier in self.tiers if tier.linguistic_type in linguistic_types]
+
+    def pairs(self, linguistic_types):
+        """
+        Tiers of given linguistic types in pairs: each (2k)th tier is the translation of the (2k-1)th tier.
+        """
+        tiers = self.tiers_of_type(linguistic_types)
+        if len(tiers) % 2 != 0:
+            raise ParseError("Tier {} has no pair. Tiers with utterances must go in pairs, "
+                             "run reshape_tiers.py first.".format(tiers[-1].tier_id))
+        return list(zip(tiers[::2], tiers[1::2]))
+
+    def speech_pairs(self, linguistic_types):
+        """
+        Pairs of tiers as (Russian tier, German tier). Tiers are supposed to be ordered Russian first, German second,
+          but a tier whose name contains latin letters is taken for the German one to help avoid mistakes.
+        """
+        result = list()
+        for tier1, tier2 in self.pairs(linguistic_types):
+            if re.search(r'[a-zA-Z]', tier1.tier_id) is not None and re.search(r'[a-zA-Z]', tier2.tier_id) is None:
+                tier1, tier2 = tier2, tier1
+            result.append((tier1, tier2))
+        return result
+
+    def tiers_by_suffix(self, regex):
+        """
+        Tiers whose names match a regular expression grouped by the name without the matching part, e.g. for the
+          regex "-NVK$" tier "Junge-NVK" is accessible by "Junge".
+        """
+        result = dict()
+        for tier in self.tiers:
+            if re.search(regex, tier.tier_id) is not None:
+                result.setdefault(re.sub(regex, "", tier.tier_id), list()).append(tier)
+        return result
+
+
+def align(ru_tier, de_tier, tolerance=TOLERANCE):
+    """
+    Pairs the intervals of a Russian tier with the intervals of its German translation.
+    Both tiers are walked once, side by side. Intervals that start more than `tolerance` ms apart are not a pair:
+      the one that starts earlier is an empty interval added by mistake and is dropped. Intervals left over at the
+      end of the longer tier are dropped too.
+    Returns a list of pairs (Russian annotation, German annotation) and a list of dropped (tier, annotation).
+    """
+    pairs, dropped = list(), list()
+    ru_all, de_all = ru_tier.annotations, de_tier.annotations
+    i = j = 0
+    while i < len(ru_all) and j < len(de_all):
+        aa_ru, aa_de = ru_all[i], de_all[j]
+        if abs(aa_ru.start - aa_de.start) > tolerance:
+            if aa_de.start < aa_ru.start:
+                dropped.append((de_tier, aa_de))
+                j += 1
+            else:
+                dropped.append((ru_tier, aa_ru))
+                i += 1
+        else:
+            pairs.append((aa_ru, aa_de))
+            i += 1
+            j += 1
+    dropped.extend((ru_tier, aa) for aa in ru_all[i:])
+    dropped.extend((de_tier, aa) for aa in de_all[j:])
+    return pairs, dropped
+
+
+def parse(content):
+    """
+    Parses the contents of an ELAN file.
+    Timeslots are encoded in ELAN files as tags:
+        First, TIME_SLOT_ID's serve as keys to TIME_VALUES in milliseconds. Some id's have no values.
+        Second, each alignable annotation has TIME_SLOT_REF1 and TIME_SLOT_REF2, timeslot id's that represent the
+            beginning and the end of an interval. Annotations that refer to a time slot with no value (such are
+            subdivisions of intervals in dependent tiers) are skipped: they cannot be placed in time.
+    """
+    root = et.fromstring(content)
+    time_slots = dict()  # key and value are {time_slot_id: time_value}
+    for ts in root.iterfind('.//TIME_ORDER/TIME_SLOT'):
+        if ts.get('TIME_VALUE') is not None:
+            time_slots[ts.get('TIME_SLOT_ID')] = int(ts.get('TIME_VALUE'))
+
+    tiers = list()
+    for tier in root.iterfind('TIER'):
+        annotations = list()
+        for aa in tier.iterfind('.//ALIGNABLE_ANNOTATION'):
+            start, end = time_slots.get(aa.get('TIME_SLOT_REF1')), time_slots.get(aa.get('TIME_SLOT_REF2'))
+            if start is None or end is None:
+                continue
+            value = aa.find("ANNOTATION_VALUE")
+            annotations.append(Annotation(start, end, value.text if value is not None else None))
+        tiers.append(Tier(tier.get("TIER_ID"), tier.get("LINGUISTIC_TYPE_REF"), annotations))
+    return Document(tiers)
+
+
+def load(efile, cache_path=CACHE_PATH):
+    """
+    Returns the Document of an ELAN file, from the cache if the file has been parsed before.
+    Set cache_path to None to parse without the cache.
+    """
+    with open(efile, 'rb') as source:
+        content = source.read()
+    if cache_path is None:
+        return parse(content)
+
+    digest = hashlib.sha1(content).hexdigest()
+    cached = os.path.join(cache_path, "{}-{}.pickle".format(digest, CACHE_VERSION))
+    try:
+        with open(cached, 'rb') as cache:
+            return pickle.load(cache)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        pass  # not cached yet or the cache file is damaged
+
+    document = parse(content)
+    os.makedirs(cache_path, exist_ok=True)
+    # a temporary file keeps parallel runs from reading a half-written cache
+    with files.replacing(cached, 'wb') as cache:
+        pickle.dump(document, cache, protocol=pickle.HIGHEST_PROTOCOL)
+    return document
@@ -0,0 +1,26 @@
+from contextlib import contextmanager
+import os
+
+# Files that other processes may read at any moment (the manifest, the media index, the ELAN cache, the work queue,
+#  reports) are written under a temporary name and then renamed, which is atomic: a reader finds either the old file
+#  or the new one, never half of it, even if the writer is killed.
+
+
+@contextmanager
+def replacing(path, mode='w'):
+    """
+    Opens a temporary file for writing and puts it in the place of path when the block ends. If the block fails,
+      the temporary file is removed and path stays as it was. The name of the temporary file holds the process id,
+      so that processes writing the same file at once do not write into each other's temporary file.
+    """
+    temporary = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(temporary, mode, encoding=None if 'b' in mode else "utf-8") as output:
+            yield output
+        os.replace(temporary, path)
+    except BaseException:
+        try:
+            os.remove(temporary)
+        except FileNotFoundError:
+            pass
+        raise
@@ -1,14 +1,21 @@
+from collections import Counter
+import gzip
 import os
 import re
-from nltk import word_tokenize
-from xml.etree import ElementTree as et
+from joblib import Parallel, delayed
 import sys
 
+import cli
+import elan
+import metrics
+import tokenizer
+
 # Any questions about this code can be sent to nadimaemi@gmail.com
 # I may answer them. I may not.
 
-ANNOT_REGEX = r"([ -]NVK|[ -]AA|[ -]Illok\.)$"
+ANNOT_REGEX = elan.ANNOTATION_REGEX
 LINGUISTIC_TYPE_REF = {"utterance"}
+ANNOT_TOLERANCE = elan.ANNOTATION_TOLERANCE  # ms; annotations start less than this far from the line they belong to
 OUT_PATH = "./VRT"
 
 
@@ -20,87 +27,44 @@ class ParseError(Exception):
         super().__init__(self.message)
 
 
-def extract_annotations(root):
+def extract_annotations(document):
     """
     Linguistic annotations are extracted based on the assumption that their names end with special symbolic sequences.
       For the files I initially have, those are "AA", "NVK", "Illok.". To add new ones alter the regular expression in
-      the ANNOT_REGEX global variable.
+      elan.ANNOTATION_REGEX.
     Linguistic annotations are have type 'list'. They are the  values in a dictionary and are accessed by the name of a
     tier without the '-AA'/' AA' or '-NVK'/' NVK' part. That means "Junge-NVK' is accessed by 'Junge'.
     """
-    result = dict()  # annotations
-    for tier in [t for t in root.findall('TIER') if re.search(ANNOT_REGEX, t.get("TIER_ID")) is not None]:
-        speaker = re.sub(ANNOT_REGEX, "", tier.get("TIER_ID"))
-        result[speaker] = result.get(speaker, list())
-        result[speaker].append(tier)
-    return result
+    return document.tiers_by_suffix(ANNOT_REGEX)
 
 
-def extract_data(efile):
+def extract_data(efile, tolerance=elan.TOLERANCE):
     """
-
+    Extracts pairs of lines in Russian and German with linguistic annotations of their speakers from an ELAN file.
+    ELAN files are parsed (or taken from the cache) by elan.load(). Intervals of paired tiers that start more than
+      `tolerance` ms apart are not a pair, see elan.align().
     """
-    time_slots = dict()  # key and value are {time_slot_id: time_value}
     speech_slices = list()
 
-    # ELAN files are represented as XML files and are parsed as such
-    root = et.parse(efile).getroot()
-    for ts in root.findall('.//TIME_ORDER/TIME_SLOT'):
-        if ts.get('TIME_VALUE') is not None:
-            time_slots[ts.get('TIME_SLOT_ID')] = int(ts.get('TIME_VALUE'))
-
-    tiers = [t for t in root.findall('TIER') if t.get("LINGUISTIC_TYPE_REF") in LINGUISTIC_TYPE_REF]
-    ling_annotations = extract_annotations(root)
-    tier_number = 0
+    document = elan.load(efile)
+    ling_annotations = extract_annotations(document)
 
-    while tier_number < len(tiers):  # a while-loop because we need to parse tiers in pairs
-        tier1, tier2 = tiers[tier_number], tiers[tier_number + 1]
-
-        # An attempt to find a tier in German based on its name; Tiers are supposed to be ordered Russian first,
-        # German second. However, this variable assignment helps avoid mistakes
-        ru_tier, de_tier = (tier1, tier2) if re.search(r'[a-zA-Z]', tier2.get("TIER_ID")) is not None else (tier2, tier1)
-        speaker = re.sub("-Spch", '', de_tier.get("TIER_ID"))
+    for ru_tier, de_tier in document.speech_pairs(LINGUISTIC_TYPE_REF):
+        speaker = re.sub("-Spch", '', de_tier.tier_id)
         try:  # only few tiers have annotations
             annot_tiers = ling_annotations[speaker]
         except KeyError:
             annot_tiers = None
 
-        aa_ru_all = ru_tier.findall('.//ALIGNABLE_ANNOTATION')
-        aa_de_all = de_tier.findall('.//ALIGNABLE_ANNOTATION')
-        idx = 0  # using index because we need to occasionally pop empty intervals from alignable annotations
-
-        while idx < min(len(aa_ru_all), len(aa_de_all)):
-            aa_ru, aa_de = aa_ru_all[idx], aa_de_all[idx]
-            start_ru = time_slots[aa_ru.get('TIME_SLOT_REF1')]
-            start_de = time_slots[aa_de.get('TIME_SLOT_REF1')]
-
-            # we pop empty intervals that have no pairs because they were added by mistake
-            if abs(int(start_ru) - int(start_de)) > 100:  # triggers if annotations are more than 100ms apart
-                if start_de < start_ru:  # lonely empty intervals appear earlier than valid ones
-                    aa_de_all.pop(idx)
-                else:
-                    aa_ru_all.pop(idx)
-            else:
-                text_ru = aa_ru.find("ANNOTATION_VALUE").text
-                text_de = aa_de.find("ANNOTATION_VALUE").text
-                annot = ''
-                if annot_tiers is not None:
-                    annot = []
-                    for annot_tier in annot_tiers:  # Annotations start ≈ when the speech does
-                        annot.extend(
-                            [an.find("ANNOTATION_VALUE").text for an in annot_tier.findall('.//ALIGNABLE_ANNOTATION') if
-                             abs(int(time_slots[an.get('TIME_SLOT_REF1')]) - int(start_de)) < 100 and
-                             an.find("ANNOTATION_VALUE").text is not None])
-                speech_slices.append([start_ru, str(text_ru), str(text_de), ' '.join(annot)])
-                idx += 1
-
-        # if len(aa_ru_all) != len(aa_de_all):
-        #     msg = ' '.join(["\nWarning! Tiers", tier1.get("TIER_ID"), "and", tier2.get("TIER_ID"),
-        #                     "have unequal lengths. Correct data before processing. "
-        #                     "Check ELAN file for blank annotations or other errors."])
-        #     raise ParseError(msg)
-
-        tier_number += 2
+        # empty intervals that have no pairs were added by mistake and are dropped
+        for aa_ru, aa_de in elan.align(ru_tier, de_tier, tolerance)[0]:
+            annot = ''
+            if annot_tiers is not None:
+                annot = []
+                for annot_tier in annot_tiers:  # Annotations start ≈ when the speech does
+                    annot.extend([an.value for an in annot_tier.starting_near(aa_de.start, ANNOT_TOLERANCE)
+                                  if an.value is not None])
+            speech_slices.append([aa_ru.start, str(aa_ru.value), str(aa_de.value), ' '.join(annot)])
 
     speech_slices.sort(key=(lambda x: x[0]))  # orders speech in the whole efile chronologically;
     utterRu, utterDe, ling_annot = list(), list(), list()
@@ -111,53 +75,115 @@ def extract_data(efile):
     return utterRu, utterDe, ling_annot
 
 
-def make_vrt(utterances, filename, language):
-    vrt = ["<meta filename={}, language={}>".format(filename, language)]
+def make_vrt(utterances, filename, language, tokenize=None):
+    """
+    Yields the lines of a .vrt document one by one, so that a document never has to be held in memory as a whole.
+    Utterances are split into words by tokenize, a tokenizer of the tokenizer module ("regex" by default).
+    """
+    tokenize = tokenize or tokenizer.get()
+    yield "<meta filename={}, language={}>".format(filename, language)
     for id_, utterance in utterances:
-        vrt.append('<Align_RU_DE id={}>'.format(id_))
-        for word in word_tokenize(utterance):
-            vrt.append(word)
-        vrt.append('</Align_RU_DE>'.format(id_))
-    vrt.append('</meta>')
-    return '\n'.join(vrt)
+        yield '<Align_RU_DE id={}>'.format(id_)
+        for word in tokenize(utterance):
+            yield word
+        yield '</Align_RU_DE>'
+    yield '</meta>'
+
+
+def write_vrt(lines, path, compress=False):
+    """
+    Writes lines to a file as they come, separated by newlines. With compress the file is gzip-compressed.
+    """
+    with (gzip.open(path, 'wt') if compress else open(path, 'w')) as output:
+        separator = ''
+        for line in lines:
+            output.write(separator)
+            output.write(line)
+            separator = '\n'
 
 
-def make_vrt_files(efile):
-    utterRU, utterDE, linguistic_annotation = extract_data(efile)
+def make_vrt_files(efile, compress=False, tokenizer_name="regex"):
+    tokenize = tokenizer.get(tokenizer_name)
     filename = os.path.splitext(os.path.split(efile)[1])[0]
-    print("\t", filename)
-    vrtRU = make_vrt(utterRU, filename, "RU")
-    vrtDE = make_vrt(utterDE, filename, "DE")
-    vrtLA = make_vrt(linguistic_annotation, filename, "annotation")
-    if not os.path.exists(OUT_PATH):
-        os.makedirs(OUT_PATH)
-    with open(os.path.join(OUT_PATH, "{}-RU.vrt".format(filename)), 'w') as output:
-        output.write(vrtRU)
-    with open(os.path.join(OUT_PATH, "{}-DE.vrt".format(filename)), 'w') as output:
-        output.write(vrtDE)
-    with open(os.path.join(OUT_PATH, "{}-annot.vrt".format(filename)), 'w') as output:
-        output.write(vrtLA)
-
-
-def main():
+    with metrics.stage("parse", filename):
+        utterRU, utterDE, linguistic_annotation = extract_data(efile)
+    print("\t", filename, flush=True)
+    os.makedirs(OUT_PATH, exist_ok=True)  # several workers may get here at once
+    extension = ".vrt.gz" if compress else ".vrt"
+    with metrics.stage("tokenize", filename):  # tokenizing and writing go together, lines are written as they come
+        write_vrt(make_vrt(utterRU, filename, "RU", tokenize),
+                  os.path.join(OUT_PATH, "{}-RU{}".format(filename, extension)), compress)
+        write_vrt(make_vrt(utterDE, filename, "DE", tokenize),
+                  os.path.join(OUT_PATH, "{}-DE{}".format(filename, extension)), compress)
+        write_vrt(make_vrt(linguistic_annotation, filename, "annotation", tokenize),
+                  os.path.join(OUT_PATH, "{}-annot{}".format(filename, extension)), compress)
+
+
+def vrt_job(efile, compress, tokenizer_name, measure, parent):
+    """
+    Runs make_vrt_files() in a worker process. With measure, the measurements of a worker (see the metrics module) are
+      returned to the main process, whose pid is parent, to be written there.
+    """
+    if measure and os.getpid() != parent:
+        if not metrics.enabled():
+            metrics.start()
+        make_vrt_files(efile, compress, tokenizer_name)
+        return metrics.drain()
+    make_vrt_files(efile, compress, tokenizer_name)
+    return list()
+
+
+def main(paths, jobs=os.cpu_count(), compress=False, tokenizer_name="regex"):
+    """
+    Makes .vrt files (.vrt.gz with compress) for ELAN files and directories with ELAN files given in paths.
+    Files are processed by `jobs` worker processes at the same time. Every worker imports this module once and keeps
+      the tokens of lines it has seen (see the tokenizer module). Each ELAN file produces its own .vrt files, so the
+      output does not depend on the order in which the workers finish.
+    """
     efiles = list()
-    for arg in sys.argv[1:]:
+    for arg in paths:
         if os.path.exists(arg) is False:
             print("Location does not exist:", arg)
             continue
         elif os.path.isdir(arg):
-            efiles = [file.path for file in os.scandir(arg) if os.path.splitext(file.path)[1] == ".eaf"]
+            efiles += [file.path for file in os.scandir(arg) if os.path.splitext(file.path)[1] == ".eaf"]
         elif os.path.splitext(arg)[1] == ".eaf":
             efiles.append(arg)
     if not efiles:
         raise ParseError("No .eaf files found")
-    for efile in efiles:
-        make_vrt_files(efile)
+
+    efiles = sorted({os.path.realpath(efile): efile for efile in efiles}.values())  # the same file given twice
+    names = Counter(os.path.splitext(os.path.split(efile)[1])[0] for efile in efiles)
+    duplicates = sorted(name for name, count in names.items() if count > 1)
+    if duplicates:  # such files would write the same .vrt files
+        raise ParseError("ELAN files with the same name in different directories: " + ', '.join(duplicates))
+
+    records = Parallel(n_jobs=min(jobs, len(efiles)))(
+        delayed(vrt_job)(efile, compress, tokenizer_name, metrics.enabled(), os.getpid()) for efile in efiles)
+    for record in [record for worker_records in records for record in worker_records]:
+        metrics.record(**record)
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        raise ParseError("Provide the path(s) to separate ELAN file(s) or to a directory as command line arguments")
+    argv = sys.argv[1:]
+    jobs = int(cli.pop_option(argv, "--jobs", os.cpu_count()))
+    metrics_path = cli.pop_option(argv, "--metrics")
+    profile_path = cli.pop_option(argv, "--profile")
+    tokenizer_name = cli.pop_option(argv, "--tokenizer", "regex")
+    compress = "--gzip" in argv
+    argv = [arg for arg in argv if arg != "--gzip"]
+    if len(argv) < 1 or jobs < 1 or tokenizer_name not in tokenizer.TOKENIZERS:
+        raise ParseError("Provide the path(s) to separate ELAN file(s) or to a directory as command line arguments\n"
+                         "Options: --jobs N  number of files to process at once (default: number of CPUs)\n"
+                         "         --gzip    write gzip-compressed .vrt.gz files\n"
+                         "         --tokenizer regex|nltk  the built-in tokenizer (default) or NLTK's word_tokenize\n"
+                         "         --metrics FILE  append timings of every stage to FILE (JSON lines)\n"
+                         "         --profile FILE  dump cProfile statistics to FILE (with --jobs 1 only, workers of\n"
+                         "           several jobs are separate processes)")
+    if metrics_path is not None or profile_path is not None:
+        metrics.start(metrics_path, profile_path)
     print("Making .vrt for:")
-    main()
-
+    try:
+        main(argv, jobs, compress, tokenizer_name)
+    finally:
+        metrics.finish()
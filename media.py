@@ -0,0 +1,89 @@
+import json
+import math
+import os
+from subprocess import DEVNULL, check_output
+
+import files
+
+# Every video is probed by ffprobe once; the results are kept in a sidecar file and reused as long as the size and the
+#  modification time of the video stay the same. Bump INDEX_VERSION whenever the entries below change.
+INDEX_PATH = "./.media_index.json"
+INDEX_VERSION = 3
+
+_entries = dict()  # {absolute path of a video: entry}, see probe()
+_checked = set()  # videos whose entries have been checked against the file in this run
+
+
+def probe(video_file):
+    """
+    Runs ffprobe on a video once and returns an entry of the index:
+        {"path": ..., "size": ..., "mtime": ..., "duration": length in ms or None if unknown,
+         "start_time": the first timestamp of the file in seconds, "codecs": {"video": [...], "audio": [...], ...}}
+    Only the header of the file is read. Keyframes are added to the entry by keyframes() when they are asked for.
+    """
+    output = check_output(['ffprobe', '-v', 'error', '-of', 'json', '-show_entries',
+                           'format=duration,start_time:stream=index,codec_type,codec_name', video_file], stdin=DEVNULL)
+    data = json.loads(output.decode("utf-8"))
+
+    codecs = dict()
+    for stream in data.get("streams", []):
+        codecs.setdefault(stream.get("codec_type"), list()).append(stream.get("codec_name"))
+
+    duration = data.get("format", {}).get("duration")
+    start_time = data.get("format", {}).get("start_time")
+    stat = os.stat(video_file)
+    return {"path": video_file, "size": stat.st_size, "mtime": stat.st_mtime_ns,
+            "duration": int(round(float(duration) * 1000)) if duration not in (None, "N/A") else None,
+            "start_time": float(start_time) if start_time not in (None, "N/A") else 0., "codecs": codecs}
+
+
+def keyframes(video_file):
+    """
+    Times of the keyframes of the first video stream in ms, in ascending order. ffprobe has to read every packet of
+      the stream to find them, so this is done only for videos that need them and the result is kept in the index.
+    Times are counted from the start of the file, as -ss counts them, and rounded up to whole milliseconds: -ss a
+      fraction of a millisecond before a keyframe would make ffmpeg seek to the previous one.
+    """
+    entry = info(video_file)
+    if "keyframes" not in entry:
+        output = check_output(['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-of', 'json', '-show_entries',
+                               'packet=pts_time,flags', video_file], stdin=DEVNULL)
+        points = list()
+        for packet in json.loads(output.decode("utf-8")).get("packets", []):
+            if 'K' in packet.get("flags", '') and packet.get("pts_time") not in (None, "N/A"):
+                # rounded to microseconds first, so that e.g. 0.1 s is not taken for 100.00000000000001 ms
+                points.append(math.ceil(round((float(packet["pts_time"]) - entry["start_time"]) * 1000, 3)))
+        entry["keyframes"] = sorted(points)
+    return entry["keyframes"]
+
+
+def load_index(index_path=INDEX_PATH):
+    """    Reads the sidecar file into memory; a missing, outdated or damaged file means videos are probed again  """
+    try:
+        with open(index_path, encoding="utf-8") as index:
+            data = json.load(index)
+        if data.get("version") == INDEX_VERSION:
+            _entries.update(data["entries"])
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+
+
+def save_index(index_path=INDEX_PATH):
+    with files.replacing(index_path) as index:
+        json.dump({"version": INDEX_VERSION, "entries": _entries}, index, ensure_ascii=False)
+
+
+def info(video_file):
+    """
+    Returns the entry of a video (see probe()), probing it only if it is not in the index yet or has changed since.
+    """
+    key = os.path.abspath(video_file)
+    entry = _entries.get(key)
+    if key not in _checked:  # a stat per run rather than per fragment, which matters on network filesystems
+        stat = os.stat(video_file)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+            entry = _entries[key] = probe(video_file)
+        _checked.add(key)
+    entry["path"] = video_file  # the same video may be given by another relative path than the one in the index
+    return entry
+
@@ -0,0 +1,156 @@
+import cProfile
+from contextlib import contextmanager
+import json
+import os
+import pstats
+import re
+import threading
+import time
+
+# Measurements of a run, switched on by the --metrics option of process_video.py and make_vrt.py. Every measurement
+#  is a JSON object on its own line of the metrics file:
+#   {"kind": "stage", "stage": "parse", "file": "Ep1", "status": 0, "wall": ..., "cpu": ..., "children_cpu": ...,
+#    "time": ...}
+#   {"kind": "ffmpeg", "command": ..., "status": 0, "wall": ..., "media": ..., "speed": ..., "time": ...}
+#  Times are in seconds; "status" of a stage is 1 if it was interrupted by an error; "cpu" is the CPU time of the
+#  thread that ran the stage, "children_cpu" that of the processes (ffmpeg) that finished meanwhile; "media" is the
+#  length of video an ffmpeg call read and "speed" is media / wall, i.e. how many times faster than realtime it went.
+#  A summary table is printed at the end of the run. With --profile the Python stages are run under cProfile as well
+#  and its statistics are dumped into a file for pstats or snakeviz.
+_enabled = False
+_output = None  # the metrics file or None if measurements are only collected, see drain()
+_records = list()  # measurements not taken by drain() yet
+_totals = dict()  # {(kind, stage): [count, failures, wall, cpu, children_cpu, media]} for the summary
+_lock = threading.Lock()  # stages run in several threads, see process_video.parse_ahead()
+_profile_path = None
+_profiles = list()
+_local = threading.local()
+
+
+def start(path=None, profile_path=None):
+    """
+    Switches measurements on. They are appended to the file at path; with path None they are only collected in memory
+      (in worker processes, see drain()). With profile_path every stage is also profiled.
+    """
+    global _enabled, _output, _profile_path
+    _enabled = True
+    if path is not None:
+        _output = open(path, 'a', encoding="utf-8")
+    _profile_path = profile_path
+
+
+def enabled():
+    return _enabled
+
+
+def record(**fields):
+    """    Keeps a measurement for the summary and writes it to the metrics file  """
+    if not _enabled:
+        return
+    fields.setdefault("time", round(time.time(), 3))
+    with _lock:
+        if _output is None:
+            _records.append(fields)
+        totals = _totals.setdefault((fields["kind"], fields.get("stage", "ffmpeg")), [0, 0, 0., 0., 0., 0.])
+        totals[0] += 1
+        totals[1] += fields.get("status", 0) != 0
+        for idx, name in enumerate(("wall", "cpu", "children_cpu", "media"), start=2):
+            totals[idx] += fields.get(name) or 0
+        if _output is not None:
+            _output.write(json.dumps(fields, ensure_ascii=False) + '\n')
+            _output.flush()
+
+
+def drain():
+    """    Takes the measurements collected so far, so that a worker process can hand them over to the main one  """
+    with _lock:
+        result = list(_records)
+        _records.clear()
+    return result
+
+
+def children_cpu_time():
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+@contextmanager
+def stage(name, file=None):
+    """
+    Measures the code in a `with` block as a stage of the run, e.g. parsing one ELAN file. Does nothing unless
+      measurements are switched on.
+    """
+    if not _enabled:
+        yield
+        return
+    profile = None
+    if _profile_path is not None and not getattr(_local, "profiling", False):
+        profile = cProfile.Profile()  # a profile only sees the thread it was enabled in, hence one per stage
+        try:
+            profile.enable()
+            _local.profiling = True
+        except ValueError:  # newer Pythons allow one active profiler per process; this stage goes unprofiled
+            profile = None
+    wall, cpu, children_cpu = time.perf_counter(), time.thread_time(), children_cpu_time()
+    status = 1  # an exception went through the block
+    try:
+        yield
+        status = 0
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+        children_cpu = children_cpu_time() - children_cpu
+        if profile is not None:
+            profile.disable()
+            _local.profiling = False
+            with _lock:
+                _profiles.append(profile)
+        record(kind="stage", stage=name, file=file, status=status, wall=round(wall, 6), cpu=round(cpu, 6),
+               children_cpu=round(children_cpu, 3))
+
+
+def media_seconds(command):
+    """    The length of video an ffmpeg command reads, taken from its -t option; None if it has none  """
+    match = re.search(r" -t (\d+(?:\.\d+)?) ", command)
+    return float(match.group(1)) if match is not None else None
+
+
+def ffmpeg(command, status, wall):
+    """    Records a finished ffmpeg call: its shell command, exit status and wall clock time in seconds  """
+    media = media_seconds(command)
+    record(kind="ffmpeg", command=command, status=status, wall=round(wall, 3), media=media,
+           speed=round(media / wall, 3) if media is not None and wall > 0 else None)
+
+
+def summary():
+    """    The table printed at the end of a run: totals per stage and of all ffmpeg calls  """
+    lines = ["{:<14} {:>7} {:>7} {:>11} {:>11} {:>11} {:>9}".format(
+        "stage", "count", "failed", "wall, s", "cpu, s", "ffmpeg cpu", "speed")]
+    for (kind, name), (count, failures, wall, cpu, children_cpu, media) in sorted(_totals.items()):
+        if kind == "ffmpeg":  # CPU time of single ffmpeg calls is unknown, it is in "ffmpeg cpu" of the stages
+            cpu = children_cpu = speed = ''
+            if media and wall:
+                speed = "{:8.2f}x".format(media / wall)
+        else:
+            cpu, children_cpu, speed = "{:.3f}".format(cpu), "{:.3f}".format(children_cpu), ''
+        lines.append("{:<14} {:>7} {:>7} {:>11.3f} {:>11} {:>11} {:>9}".format(
+            name, count, failures, wall, cpu, children_cpu, speed))
+    return '\n'.join(lines)
+
+
+def finish():
+    """    Prints the summary, closes the metrics file and dumps the profile  """
+    global _enabled, _output
+    if not _enabled:
+        return
+    print(summary(), flush=True)
+    if _output is not None:
+        print("Metrics are written to", _output.name)
+        _output.close()
+        _output = None
+    if _profile_path is not None and _profiles:
+        stats = pstats.Stats(_profiles[0])
+        for profile in _profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(_profile_path)
+        print("Profile is written to", _profile_path)
+    _enabled = False
@@ -1,9 +1,25 @@
+import csv
+import hashlib
+import json
 import os
+import queue
 import re
-from subprocess import DEVNULL, check_call
+import shutil
+from bisect import bisect_right
+from subprocess import DEVNULL, STDOUT, CalledProcessError, Popen, check_call, check_output
+import socket
 import sys
-import datetime as dt
-from xml.etree import ElementTree as et
+import tempfile
+import threading
+import time
+
+import cli
+import corpus
+import elan
+import files
+import media
+import metrics
+import workqueue
 
 # Any questions about this code can be sent to nadimaemi@gmail.com
 # I may answer them. I may not.
@@ -13,6 +29,53 @@ from xml.etree import ElementTree as et
 #  a ffmpeg command
 already_created = set()
 LINGUISTIC_TYPE_REF = {"utterance"}  # we are interested in specific tiers for cutting videos
+POLL_INTERVAL = 0.05  # seconds between checks of running ffmpeg processes
+SUBTITLE_MODES = {"fragment", "episode"}  # one .ass per fragment (times from zero) or per episode (absolute times)
+MANIFEST = "./OUT/.manifest.json"  # remembers what every fragment in OUT was made from, see fragment_key()
+PARTIAL_PREFIX = ".partial-"  # ffmpeg writes here first; a fragment gets its real name only when it is complete
+# Encoded fragments by content, see content_key(); files in OUT are links to them, so a fragment that would come out
+#  the same under another name (a line of another tier with the same time span, a rerun after renumbering) is not
+#  encoded again. Delete the directory to free the space of fragments that are no longer in OUT.
+STORE = "./OUT/.store"
+store_saved = {"fragments": 0, "seconds": 0.}  # fragments of this run taken from the store and their encode time
+ENGINES = {"slice", "batch", "auto"}  # one ffmpeg per fragment, one per batch of close fragments, or measure both
+BATCH_GAP = 10000  # milliseconds; fragments closer than this are cut by the same ffmpeg in the "batch" engine
+BATCH_SIZE = 32  # at most that many fragments per ffmpeg in the "batch" engine
+PIPELINE_DEPTH = 2  # parsed ELAN files that may wait for their turn to be cut, see parse_ahead()
+MODES = {"burn", "copy"}  # re-encode with subtitles in the picture, or stream copy with subtitle tracks
+# Codecs of subtitle tracks in "copy" mode by container; containers not listed get no subtitle tracks
+SOFT_SUBTITLE_CODECS = {".mp4": "mov_text", ".m4v": "mov_text", ".mov": "mov_text", ".mkv": "ass",
+                        ".webm": "webvtt"}
+# The encode settings that make the most fragments per hour on this machine, chosen by tune(). Without the file ffmpeg
+#  picks its defaults. The settings are for libx264, so they are only used with the containers listed.
+ENCODE_PROFILE = "./.encode_profile.json"
+PROFILE_CONTAINERS = {".mp4", ".m4v", ".mov", ".mkv"}
+TUNE_PRESETS = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium"]  # x264 presets tune() tries
+MIN_SSIM = 0.97  # the quality floor of tune(): SSIM of every sample fragment against a lossless encode of it
+LOSSLESS = " -c:v libx264 -preset ultrafast -qp 0 -pix_fmt yuv420p"  # the reference encode of tune()
+_profile = None  # the encode profile, read once per run, see encode_options()
+
+# Look of the subtitles burned into the picture. Sizes are in the coordinates of PlayResX x PlayResY (the script
+#  resolution), which libass scales to the actual video. Colours are &HBBGGRR. Alignment 2 is bottom center.
+ASS_STYLE = {"font": "Arial", "size": 16, "colour": "&Hffffff", "outline_colour": "&H0", "outline": 1, "shadow": 0,
+             "alignment": 2, "margin_v": 10, "play_res_x": 384, "play_res_y": 288}
+ASS_LAYOUT = "{ru}\\N{de}"  # Russian line on top of the German one; \N is a line break in ASS
+ASS_HEADER = """[Script Info]
+ScriptType: v4.00+
+PlayResX: {play_res_x}
+PlayResY: {play_res_y}
+ScaledBorderAndShadow: yes
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, \
+Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, \
+MarginV, Encoding
+Style: Default,{font},{size},{colour},{colour},{outline_colour},&H0,0,0,0,0,100,100,0,0,1,{outline},{shadow},\
+{alignment},10,10,{margin_v},0
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+"""
 
 
 class ParseError(Exception):
@@ -30,187 +93,972 @@ def mkdir(name):
         pass
 
 
-def make_subtitles(filename, slice_):
+def ass_time(milliseconds):
+    """    Formats milliseconds as an ASS time value H:MM:SS.cc (centiseconds)  """
+    centiseconds = int(round(milliseconds / 10))
+    return "{}:{:02}:{:02}.{:02}".format(centiseconds // 360000, centiseconds // 6000 % 60,
+                                          centiseconds // 100 % 60, centiseconds % 100)
+
+
+def ass_text(text):
+    """    Escapes a line for the Text field of an ASS event: braces start override tags, newlines become \\N  """
+    return re.sub(r"\r?\n", r"\\N", str(text).replace("{", r"\{").replace("}", r"\}"))
+
+
+def write_ass(path, events, style=ASS_STYLE):
+    """
+    Writes an .ass file with one Dialogue line per event. Events are (start, end, text) with times in milliseconds
+      and text already laid out (see ASS_LAYOUT).
+    """
+    with open(path, 'w', encoding="utf-8") as subs:
+        subs.write(ASS_HEADER.format(**style))
+        for start, end, text in events:
+            subs.write("Dialogue: 0,{},{},Default,,0,0,0,,{}\n".format(ass_time(start), ass_time(end), text))
+
+
+def make_subtitles(filename, slice_, mode="fragment"):
     """
-    Makes an .srt files in Subtitles directory for each videofile.
-    Then converts them to .ass files to hardcode them into the picture via ffmpeg.
+    Makes .ass files in Subtitles directory to hardcode them into the picture via ffmpeg. The files are written
+      directly, no ffmpeg conversion is involved.
 
-    Having that many subtitles files is necessary to make ffmpeg faster:
-      when the -ss option stands before the -i option ffmpeg does not read the whole video to reach lines which
-      appear at the end of the file. Otherwise it can take about 20 seconds to make subtitles for a single fragment.
-    As a tradeoff, subtitles should then start from 00:00:00 for each video fragment. Therefore, no single file for
-      subtitles can be used.
-    For details on the order of arguments check the manual for this command.
+    In "fragment" mode there is one .ass file per fragment of a videofile, its only line starting from 00:00:00.
+      When the -ss option stands before the -i option ffmpeg does not read the whole video to reach lines which
+      appear at the end of the file (otherwise it can take about 20 seconds to make subtitles for a single fragment),
+      but the timestamps of the fragment start from zero, so the subtitles have to as well.
+    In "episode" mode all lines go to a single ./Subtitles/<filename>/<filename>.ass with times as they are in the
+      ELAN file. cut_command() then shifts the timestamps of the fragment back by its start before the subtitles are
+      drawn, which keeps the fast seeking and the alignment.
+    In "tracks" mode (used by copy_command()) there are two files with times as they are in the ELAN file,
+      ./Subtitles/<filename>/<filename>-RU.ass and -DE.ass, one per subtitle track.
     """
     mkdir("./Subtitles/{}".format(filename))
+    if mode == "tracks":
+        for language, column in (("RU", 2), ("DE", 3)):
+            events = {(line[0], line[1], ass_text(line[column])) for line in slice_}
+            write_ass("./Subtitles/{0}/{0}-{1}.ass".format(filename, language), sorted(events))
+        return
+    if mode == "episode":
+        # a set, because identical lines would otherwise be drawn twice on top of each other
+        events = {(start, end, ASS_LAYOUT.format(ru=ass_text(textRu), de=ass_text(textDe)))
+                  for start, end, textRu, textDe, tier_id in slice_}
+        write_ass("./Subtitles/{0}/{0}.ass".format(filename), sorted(events))
+        return
     for start, end, textRu, textDe, tier_id in slice_:
-        mkdir("./Subtitles/{}/SRT".format(filename))
-
         subtitle_name = "{}-{}-{}-{}".format(filename, start, end, tier_id)
-        start, end = "00:00:00,000", str(dt.timedelta(milliseconds=end - start))
-        end += ",000" if len(end) == 7 else "0" * (11 - len(end))  # to comply with the srt format of time values.
-        subs = open("./Subtitles/{}/SRT/{}.srt".format(filename, subtitle_name), 'w')
-        subs.write("1\n" +
-                   re.sub(r'\.', ',', "{} --> {}\n".format(start, end)) +
-                   "{}\n".format(textRu) +
-                   "{}\n\n".format(textDe))
-        subs.close()
-        command = \
-            "ffmpeg -i ./Subtitles/{}/SRT/{}.srt ./Subtitles/{}/{}.ass".format(filename, subtitle_name,
-                                                                               filename, subtitle_name)
-        check_call(['/bin/sh', '-c', command + " -y -loglevel 24"], stdout=DEVNULL)
-    check_call(['rm', '-rd', "./Subtitles/{}/SRT".format(filename)])  # clear unnecessary .srt files
-
-
-def cut_video(video_path, filename, slice_):
-    """
-     Write a ffmpeg command to VideoBatch.sh
+        text = ASS_LAYOUT.format(ru=ass_text(textRu), de=ass_text(textDe))
+        write_ass("./Subtitles/{}/{}.ass".format(filename, subtitle_name), [(0, end - start, text)])
+
+
+def load_profile(path=ENCODE_PROFILE):
+    """    Reads the encode profile written by tune(); an empty dict if there is none: ffmpeg's defaults are used  """
+    try:
+        with open(path, encoding="utf-8") as profile:
+            return json.load(profile)
+    except FileNotFoundError:
+        return dict()
+    except ValueError:
+        print("Warning! The encode profile", path, "is corrupt, ffmpeg's defaults are used.")
+        return dict()
+
+
+def profile_options(profile, extension):
+    """    ffmpeg output options of an encode profile for a container, '' if there are none  """
+    if not profile or extension.lower() not in PROFILE_CONTAINERS:
+        return ''
+    options = " -c:v {} -preset {} -threads {}".format(profile.get("codec", "libx264"), profile["preset"],
+                                                     profile["threads"])
+    if profile.get("pix_fmt"):
+        options += " -pix_fmt {}".format(profile["pix_fmt"])
+    return options
+
+
+def encode_options(extension):
+    """    Options of the encode profile in ENCODE_PROFILE, see profile_options()  """
+    global _profile
+    if _profile is None:
+        _profile = load_profile()
+    return profile_options(_profile, extension)
+
+
+def cut_command(video_file, filename, slice_, subtitles_mode="fragment", options=None):
+    """
+     Make a ffmpeg command that cuts one fragment out of a video.
      A prototypical ffmpeg command for this function looks like this:
         ffmpeg -ss <start Time> -i <input file> -t <duration Time> <output_file_with_extension>
      For details on options used here read "man ffmpeg", for Time format read 'man ffmpeg-utils'.
+     With subtitles of the whole episode (see make_subtitles()) the filter chain is
+        setpts=PTS+<start>/TB,ass=<file>,setpts=PTS-STARTPTS
+       i.e. frames get their timestamps in the source video back while the subtitles are drawn, and the fragment
+       starts from zero again afterwards.
+     ffmpeg writes to ./OUT/<PARTIAL_PREFIX><name>; finish_fragment() or store_fragment() gives the file its name when
+       it is complete.
+     The video is encoded with options, by default those of the encode profile (see encode_options()).
+     Returns a tuple (name of the fragment, command) or None if the fragment has already been scheduled in this run.
     """
     # GET TIME VALUES
     i = filename
     ss = slice_[0] / 1000
     t = (slice_[1] - slice_[0]) / 1000
 
-    # GET PROPER FILENAME AND EXTENSION
-    r = re.compile(r"{}\.[a-zA-Z0-9]*".format(filename))
-    # Variable full_filename takes the first one from all matching videos, because filenames are supposed to be
-    #  unique, as mentioned in the docsting to main()
-    full_filename = list(filter(r.match, os.listdir(video_path)))[0]
-    extension = full_filename[len(filename):]
-
+    # the extension of the video is preserved to avoid loss of quality
+    extension = os.path.splitext(video_file)[1]
     cut_result = "{}-{}-{}-{}{}".format(i, slice_[0], slice_[1], slice_[4], extension)
     if cut_result in already_created:
-        return
+        return None
     else:
         already_created.add(cut_result)
 
-    subtitles = "./Subtitles/{}/{}-{}-{}-{}.ass".format(filename, filename, slice_[0], slice_[1], slice_[4])
-    command = \
-        "ffmpeg -ss {} -i {}/{}{} -t {} -vf ass={} ./OUT/{}".format(ss, video_path, filename,
-                                                                    extension, t, subtitles, cut_result)
-    check_call(['/bin/sh', '-c', command + " -y -loglevel 24"])
+    if subtitles_mode == "episode":
+        video_filter = "setpts=PTS+{}/TB,ass=./Subtitles/{}/{}.ass,setpts=PTS-STARTPTS".format(ss, filename, filename)
+    else:
+        subtitles = "./Subtitles/{}/{}-{}-{}-{}.ass".format(filename, filename, slice_[0], slice_[1], slice_[4])
+        video_filter = "ass={}".format(subtitles)
+    if options is None:
+        options = encode_options(extension)
+    command = "ffmpeg -ss {} -i {} -t {} -vf {}{} ./OUT/{}{}".format(ss, video_file, t, video_filter, options,
+                                                                     PARTIAL_PREFIX, cut_result)
+    return cut_result, command + " -y -loglevel 24"
+
+
+def copy_command(video_file, filename, slice_):
+    """
+     Make a ffmpeg command that cuts one fragment out of a video without re-encoding it:
+        ffmpeg -ss <keyframe> -i <input> -ss <keyframe> -i <RU .ass> -ss <keyframe> -i <DE .ass> -t <duration>
+               -map 0:v -map 0:a? -map 1 -map 2 -c copy -c:s <codec> <output>
+     Stream copy can only start at a keyframe, so the start of the fragment is moved back to the closest keyframe
+       (see media.keyframes()). The Russian and German lines are added as subtitle tracks rather than drawn into the
+       picture; their files are seeked by the same amount, so they stay aligned (see make_subtitles() in "tracks"
+       mode).
+     Returns a tuple (name of the fragment, command, how many ms the start was moved) or None if the fragment has
+       already been scheduled in this run.
+    """
+    extension = os.path.splitext(video_file)[1]
+    cut_result = "{}-{}-{}-{}{}".format(filename, slice_[0], slice_[1], slice_[4], extension)
+    if cut_result in already_created:
+        return None
+    already_created.add(cut_result)
+
+    points = media.keyframes(video_file)
+    idx = bisect_right(points, slice_[0])
+    start = points[idx - 1] if idx > 0 else 0
+    ss, t = start / 1000, (slice_[1] - start) / 1000
+
+    command = "ffmpeg -ss {} -i {}".format(ss, video_file)
+    codec = SOFT_SUBTITLE_CODECS.get(extension.lower())
+    if codec is not None:
+        for language in ("RU", "DE"):
+            command += " -ss {} -i ./Subtitles/{}/{}-{}.ass".format(ss, filename, filename, language)
+        command += " -t {} -map 0:v -map '0:a?' -map 1 -map 2 -c copy -c:s {}".format(t, codec)
+        command += " -metadata:s:s:0 language=rus -metadata:s:s:1 language=ger"
+    else:
+        command += " -t {} -map 0:v -map '0:a?' -c copy".format(t)
+    command += " ./OUT/{}{} -y -loglevel 24".format(PARTIAL_PREFIX, cut_result)
+    return cut_result, command, slice_[0] - start
+
+
+def plan_batches(slices, gap=BATCH_GAP, size=BATCH_SIZE):
+    """
+    Groups fragments ordered by start time into batches of close ones: a fragment joins the current batch if it
+      starts less than `gap` ms after the end of the batch and the batch is not full. Sparse fragments end up alone.
+    """
+    batches = list()
+    for slice_ in sorted(slices, key=(lambda x: x[0])):
+        if batches and len(batches[-1]) < size and slice_[0] - max(s[1] for s in batches[-1]) < gap:
+            batches[-1].append(slice_)
+        else:
+            batches.append([slice_])
+    return batches
+
+
+def batch_command(video_file, filename, batch, subtitles_mode="fragment", options=None):
+    """
+     Make one ffmpeg command that cuts a batch of fragments out of a video, decoding the video only once:
+        ffmpeg -ss <batch start> -t <batch duration> -i <input file> -filter_complex <graph> <outputs>
+     In the filter graph the video (and the audio) is split into a branch per fragment, and each branch is trimmed
+       to its fragment and starts from zero again. The subtitles of a fragment are drawn after the trim; subtitles
+       of the whole episode are drawn once, before the split, on the timestamps of the source video.
+     Returns a tuple (names of the fragments, command). Fragment names, output and options are the same as of
+       cut_command().
+    """
+    extension = os.path.splitext(video_file)[1]
+    if options is None:
+        options = encode_options(extension)
+    audio = "audio" in media.info(video_file)["codecs"]
+    start, end = min(s[0] for s in batch), max(s[1] for s in batch)
+    n = len(batch)
+
+    if subtitles_mode == "episode":
+        graph = ["[0:v]setpts=PTS+{}/TB,ass=./Subtitles/{}/{}.ass,split={}{}".format(
+            start / 1000, filename, filename, n, ''.join("[v{}]".format(k) for k in range(n)))]
+    else:
+        graph = ["[0:v]split={}{}".format(n, ''.join("[v{}]".format(k) for k in range(n)))]
+    if audio:
+        graph.append("[0:a]asplit={}{}".format(n, ''.join("[a{}]".format(k) for k in range(n))))
+
+    names, outputs = list(), list()
+    for k, slice_ in enumerate(batch):
+        relative_start, relative_end = (slice_[0] - start) / 1000, (slice_[1] - start) / 1000
+        if subtitles_mode == "episode":
+            graph.append("[v{}]trim=start={}:end={},setpts=PTS-STARTPTS[o{}]".format(
+                k, slice_[0] / 1000, slice_[1] / 1000, k))
+        else:
+            graph.append("[v{}]trim=start={}:end={},setpts=PTS-STARTPTS,ass=./Subtitles/{}/{}-{}-{}-{}.ass[o{}]".format(
+                k, relative_start, relative_end, filename, filename, slice_[0], slice_[1], slice_[4], k))
+        maps = "-map '[o{}]'".format(k)
+        if audio:
+            graph.append("[a{}]atrim=start={}:end={},asetpts=PTS-STARTPTS[p{}]".format(
+                k, relative_start, relative_end, k))
+            maps += " -map '[p{}]'".format(k)
+        cut_result = "{}-{}-{}-{}{}".format(filename, slice_[0], slice_[1], slice_[4], extension)
+        names.append(cut_result)
+        outputs.append("{}{} ./OUT/{}{}".format(maps, options, PARTIAL_PREFIX, cut_result))
+
+    command = "ffmpeg -ss {} -t {} -i {} -filter_complex \"{}\" {}".format(
+        start / 1000, (end - start) / 1000, video_file, ';'.join(graph), ' '.join(outputs))
+    return names, command + " -y -loglevel 24"
+
+
+def finish_fragment(cut_result):
+    """    Gives a fragment written by ffmpeg its final name in OUT  """
+    os.replace("./OUT/{}{}".format(PARTIAL_PREFIX, cut_result), "./OUT/{}".format(cut_result))
+
+
+def link(source, target):
+    """    Makes target a hard link to source or, where hard links are impossible, a relative symbolic link  """
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:  # another filesystem, or one without hard links
+        os.symlink(os.path.relpath(source, os.path.dirname(target)), target)
+
+
+def store_fragment(cut_result, key, content, seconds):
+    """
+    Moves a fragment written by ffmpeg into the store and links it to its name in OUT. If ffmpeg did not write it (a
+      duplicate of a fragment of the same content, see episode_jobs()), the stored file is linked. seconds is how
+      long the fragment took to encode. Returns the entry of the manifest for the fragment.
+    """
+    stored = os.path.join(STORE, content + os.path.splitext(cut_result)[1])
+    partial = "./OUT/{}{}".format(PARTIAL_PREFIX, cut_result)
+    if os.path.exists(partial):
+        os.replace(partial, stored)
+    link(stored, "./OUT/{}".format(cut_result))
+    return {"key": key, "size": os.path.getsize(stored), "content": content, "encode": round(seconds, 3)}
+
+
+def finish_outputs(outputs, wall):
+    """
+    Stores the fragments an ffmpeg command has made, see schedule() for outputs. The wall clock time of the command is
+      shared among the fragments it encoded; duplicates are counted as saved. Returns {name: entry of the manifest}.
+    """
+    encoded = {o[0] for o in outputs if os.path.exists("./OUT/{}{}".format(PARTIAL_PREFIX, o[0]))}
+    seconds = wall / max(1, len(encoded))
+    result = dict()
+    for cut_result, key, content in outputs:
+        if cut_result not in encoded:
+            store_saved["fragments"] += 1
+            store_saved["seconds"] += seconds
+        result[cut_result] = store_fragment(cut_result, key, content, seconds)
+    return result
+
+
+def print_saved():
+    if store_saved["fragments"]:
+        print("{} fragments were taken from the store instead of being encoded, about {:.1f} encode-seconds saved"
+              .format(store_saved["fragments"], store_saved["seconds"]), flush=True)
+
+
+def cut_video(video_file, filename, slice_, subtitles_mode="fragment"):
+    """
+     Cut one fragment out of a video and wait for ffmpeg to finish. See cut_command() for the command itself.
+    """
+    job = cut_command(video_file, filename, slice_, subtitles_mode)
+    if job is not None:
+        check_call(['/bin/sh', '-c', job[1]], stdin=DEVNULL)
+        finish_fragment(job[0])
+
+
+def load_manifest(path=MANIFEST):
+    """
+    Reads the manifest of fragments made by previous runs: {fragment name: {"key": ..., "size": ...}}.
+    A missing or unreadable manifest (e.g. a run killed while saving it) means every fragment is made again.
+    """
+    try:
+        with open(path, encoding="utf-8") as manifest:
+            return json.load(manifest)
+    except FileNotFoundError:
+        return dict()
+    except ValueError:
+        print("Warning! The manifest", path, "is corrupt, all fragments will be made again.")
+        return dict()
+
+
+def save_manifest(manifest, path=MANIFEST):
+    """    Writes the manifest to a temporary file first, so that an interrupted run never leaves half of it  """
+    with files.replacing(path) as output:
+        json.dump(manifest, output, ensure_ascii=False, indent=0, sort_keys=True)
+
+
+def command_template(video_file, command):
+    """
+    The command with a placeholder instead of the path of the video, which is given as it was typed: V, ./V and
+      $PWD/V are the same video, and fragment_key() has its absolute path anyway.
+    """
+    return command.replace(" -i {} ".format(video_file), " -i {video} ")
+
+
+def fragment_key(video_file, command, payload):
+    """
+    A key that changes whenever a fragment would come out differently: the identity of the source video (path,
+      size, modification time), the ffmpeg command (start/end, id, filters, encode settings), the look of the
+      subtitles and their text (payload).
+    """
+    entry = media.info(video_file)
+    material = [os.path.abspath(video_file), entry["size"], entry["mtime"], command_template(video_file, command),
+                ASS_STYLE, ASS_LAYOUT, payload]
+    return hashlib.sha1(json.dumps(material, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def content_key(video_file, command, payload, cut_result):
+    """
+    Like fragment_key(), but independent of the name of the fragment: fragments of equal content keys are the same
+      file, whatever line, tier or episode they were made for. The name (which is also in the names of the .ass
+      files of single fragments) is replaced in the command before it is hashed. The path of the video is replaced
+      first (see command_template()), so that the store is shared by runs that give the video by different paths,
+      and a path that contains the name stays intact.
+    """
+    command = command_template(video_file, command)
+    return fragment_key(video_file, command.replace(os.path.splitext(cut_result)[0], "{fragment}"), payload)
+
+
+def subtitle_payload(slices, slice_, subtitles_mode="fragment"):
+    """
+    The subtitle lines that end up in the picture of a fragment: its own pair of lines or, with subtitles of the
+      whole episode, every line that overlaps the fragment.
+    """
+    if subtitles_mode == "episode":
+        return [other[:4] for other in slices if other[0] < slice_[1] and other[1] > slice_[0]]
+    return slice_[2:4]
+
+
+def is_up_to_date(manifest, cut_result, key):
+    """    A fragment need not be made again if it was made from the same data and the file is complete  """
+    entry = manifest.get(cut_result)
+    if entry is None or entry["key"] != key:
+        return False
+    try:
+        return os.path.getsize("./OUT/{}".format(cut_result)) == entry["size"]
+    except FileNotFoundError:
+        return False
+
+
+def run_commands(commands, jobs=os.cpu_count(), on_done=None, sizes=None):
+    """
+    Runs shell commands (ffmpeg calls) on a pool of at most `jobs` concurrent processes and prints the progress.
+    If a command fails, the remaining ones are not started, the running ones are terminated and CalledProcessError
+      is raised. The same clean-up happens on KeyboardInterrupt, so Ctrl-C does not leave stray ffmpeg processes.
+    on_done, if given, is called with every command that has finished successfully and its wall clock time.
+    sizes, if given, maps commands to the number of fragments they make (one by default) for the progress.
+    Every finished command is recorded by metrics.ffmpeg() if metrics are switched on.
+    """
+    sizes = sizes or dict()
+    pending = list(reversed(commands))  # popping from the end keeps the original order
+    total, finished = sum(sizes.get(command, 1) for command in pending), 0
+    running = list()
+    started = dict()  # {process: when it was started}
+    try:
+        while pending or running:
+            while pending and len(running) < jobs:
+                # stdin is closed so that concurrent ffmpeg processes do not compete for the terminal
+                running.append(Popen(['/bin/sh', '-c', pending.pop()], stdin=DEVNULL))
+                started[running[-1]] = time.perf_counter()
+            time.sleep(POLL_INTERVAL)
+            for process in [p for p in running if p.poll() is not None]:
+                running.remove(process)
+                metrics.ffmpeg(process.args[-1], process.returncode, time.perf_counter() - started[process])
+                if process.returncode != 0:
+                    raise CalledProcessError(process.returncode, process.args)
+                finished += sizes.get(process.args[-1], 1)
+                if on_done is not None:
+                    on_done(process.args[-1], time.perf_counter() - started[process])
+                print("\r\t{}/{} fragments".format(finished, total), end='', flush=True)
+    finally:
+        for process in running:
+            process.terminate()
+        for process in running:
+            process.wait()
+            metrics.ffmpeg(process.args[-1], process.returncode, time.perf_counter() - started[process])
+    if total:
+        print(flush=True)
+
+
+def episode_jobs(video_file, filename, slices, manifest, subtitles_mode="fragment", mode="burn", ids=None,
+                 finished=None):
+    """
+    Makes the ffmpeg commands for the fragments of an episode that are not up to date in the manifest.
+    finished ({name of a fragment: entry of the manifest}) holds fragments made by workers (see plan()); an entry is
+      recorded in the manifest if its key is the key the fragment has now, otherwise the fragment is made again.
+    In "copy" mode fragments are cut by copy_command(), and how far their starts were moved to keyframes is
+      summarised on the screen and listed in ./OUT/.snapped-<filename>.csv.
+    A fragment whose content (see content_key()) is in the store already is linked to it at once. Of fragments with
+      the same content only the first one is encoded, the others are its duplicates and are linked when it is done.
+    With ids (a set of ids of lines) only those lines are cut; the others still count for the subtitles of the
+      episode (see subtitle_payload()), so the fragments come out the same as in a run of the whole episode.
+    Returns {id of a fragment: (slice, name of the fragment, key, command of cut_command() or copy_command(),
+      content key, [(name, key) of duplicates])}.
+    """
+    todo, up_to_date, stored = dict(), 0, 0
+    shifts = list()  # [(name of a fragment, ms its start was moved to a keyframe)]
+    mkdir(STORE)
+    encode_time = {entry["content"]: entry.get("encode", 0) for entry in manifest.values() if "content" in entry}
+    first = dict()  # {content key: id of the fragment encoded for it}
+    for slice_ in slices:
+        if ids is not None and slice_[4] not in ids:
+            continue
+        if mode == "copy":
+            job = copy_command(video_file, filename, slice_)
+            payload = subtitle_payload(slices, slice_, "episode")  # the tracks hold every line of the time span
+        else:
+            job = cut_command(video_file, filename, slice_, subtitles_mode)
+            payload = subtitle_payload(slices, slice_, subtitles_mode)
+        if job is None:
+            continue
+        if mode == "copy":
+            shifts.append((job[0], job[2]))
+        key = fragment_key(video_file, job[1], payload)
+        if finished is not None and job[0] in finished and finished[job[0]]["key"] == key:
+            manifest[job[0]] = finished[job[0]]
+        if is_up_to_date(manifest, job[0], key):
+            up_to_date += 1
+            continue
+        content = content_key(video_file, job[1], payload, job[0])
+        if os.path.exists(os.path.join(STORE, content + os.path.splitext(job[0])[1])):
+            manifest[job[0]] = store_fragment(job[0], key, content, encode_time.get(content, 0))
+            store_saved["fragments"] += 1
+            store_saved["seconds"] += encode_time.get(content, 0)
+            stored += 1
+        elif content in first:
+            todo[first[content]][5].append((job[0], key))
+        else:
+            first[content] = slice_[4]
+            todo[slice_[4]] = (slice_, job[0], key, job[1], content, list())
+    if up_to_date:
+        print("\t{} fragments are up to date".format(up_to_date))
+    if stored:
+        print("\t{} fragments are taken from the store".format(stored))
+    if shifts:
+        with open("./OUT/.snapped-{}.csv".format(filename), 'w', newline='') as report:
+            csv.writer(report).writerows([("fragment", "moved_ms")] + shifts)
+        print("\tStarts moved to keyframes by {:.0f} ms on average, {} ms at most".format(
+            sum(shift for _, shift in shifts) / len(shifts), max(shift for _, shift in shifts)))
+    return todo
+
+
+def schedule(video_file, filename, batch, todo, engine="slice", subtitles_mode="fragment"):
+    """
+    Turns a batch of fragments from episode_jobs() into ffmpeg commands: one batch_command() for the "batch" engine,
+      otherwise a command per fragment. Returns a list of tuples (command, [(name of a fragment, key, content key),
+      ...]); the fragments a command encodes come first, their duplicates (see episode_jobs()) after them.
+    """
+    def outputs(slices):
+        jobs = [todo[slice_[4]] for slice_ in slices]
+        return [(job[1], job[2], job[4]) for job in jobs] + \
+            [(name, key, job[4]) for job in jobs for name, key in job[5]]
+
+    if engine == "batch" and len(batch) > 1:
+        command = batch_command(video_file, filename, batch, subtitles_mode)[1]
+        return [(command, outputs(batch))]
+    return [(todo[slice_[4]][3], outputs([slice_])) for slice_ in batch]
 
 
-def extract_speech(efiles):
+def cut_episode(video_file, filename, slices, manifest, jobs=os.cpu_count(), subtitles_mode="fragment",
+                engine="slice", mode="burn", ids=None):
+    """
+    Cuts the fragments of an episode that are not up to date in the manifest and records them there. With ids only
+      the lines with those ids are cut, see episode_jobs().
+    The "slice" engine runs an ffmpeg per fragment (cut_command()), the "batch" engine an ffmpeg per batch of close
+      fragments (batch_command()); lonely fragments are cut by cut_command() in both. The "auto" engine cuts one batch
+      with each engine first, compares the CPU time per second of video they took and uses the cheaper one for the
+      rest of the episode. In "copy" mode (copy_command()) every fragment gets its own ffmpeg.
+    """
+    todo = episode_jobs(video_file, filename, slices, manifest, subtitles_mode, mode, ids)
+    if mode == "copy":
+        engine = "slice"  # stream copy costs next to nothing, there is nothing to share between fragments
+
+    pending = dict()  # {command: [(fragment name, key, content key), ...]}
+
+    def on_done(command, wall):
+        manifest.update(finish_outputs(pending[command], wall))
+
+    def run(batches, engine_):
+        commands = list()
+        for batch in batches:
+            for command, outputs in schedule(video_file, filename, batch, todo, engine_, subtitles_mode):
+                pending[command] = outputs
+                commands.append(command)
+        run_commands(commands, jobs, on_done, {command: len(pending[command]) for command in commands})
+
+    batches = plan_batches([t[0] for t in todo.values()])
+    if engine == "auto":
+        samples = [batch for batch in batches if len(batch) > 1][:2]
+        engine = "slice"
+        if len(samples) == 2:
+            costs = list()
+            for sample, engine_ in zip(samples, ("batch", "slice")):
+                batches.remove(sample)
+                cpu_time = metrics.children_cpu_time()
+                run([sample], engine_)
+                costs.append((metrics.children_cpu_time() - cpu_time) / sum(s[1] - s[0] for s in sample) * 1000)
+            engine = "batch" if costs[0] < costs[1] else "slice"
+            print("\tCPU seconds per second of video: batch {:.3f}, slice {:.3f}; using {}".format(*costs, engine))
+    run(batches, engine)
+
+
+def iter_speech(efiles, tolerance=elan.TOLERANCE):
     """
     This function extracts speech from intervals and saves it, as well as its' translation, the time when the line is
     pronounces and the name of the tier (typically the speaker's name).
-    Timeslots are encloded in ELAN files as tags:
-        First, TIME_SLOT_ID's serve as keys to TIME_VALUES in milliseconds. Some id's have no values - they are ignored.
-        Second, each fragment of speech has TIME_SLOT_REF1 and TIME_SLOT_REF1, timeslot id's that represent the
-            beginning and the end of a fragment.
+    ELAN files are parsed (or taken from the cache) by elan.load(), see the elan module for how timeslots are read.
+    Intervals of paired tiers that start more than `tolerance` ms apart are not a pair, see elan.align().
+    Yields a tuple (name of an ELAN file, its intervals) as soon as a file is parsed.
     """
-    time_slots = dict()  # key and value are {time_slot_id: time_value}
-    speech_slices = dict()  # ties intervals in an ELAN file to the name of this file
-
-    print("Parsing ELAN files")
     for efile in efiles:
         filename, extension = os.path.splitext(os.path.split(efile)[1])
         if extension != ".eaf":
             continue
-        print("\t", efile, sep='')
-        speech_slices[filename] = list()
-
-        # ELAN files are XML files and are parsed accordingly
-        root = et.parse(efile).getroot()
-        for ts in root.findall('.//TIME_ORDER/TIME_SLOT'):
-            if ts.get('TIME_VALUE') is not None:
-                time_slots[ts.get('TIME_SLOT_ID')] = int(ts.get('TIME_VALUE'))
-
-        tiers = [t for t in root.findall('TIER') if t.get("LINGUISTIC_TYPE_REF") in LINGUISTIC_TYPE_REF]
-        tier_number = 0  # each (2k)th tier is the translation of (2k-1)th tier (note that index [1] points to tier 2)
-
-        while tier_number < len(tiers):  # a while-loop because we need to parse tiers in pairs
-            tier1, tier2 = tiers[tier_number], tiers[tier_number + 1]
-
-            # An attempt to find a tier in German based on its name; Tiers are supposed to be ordered Russian first,
-            # German second. However, this variable assignment helps avoid mistakes
-            ru_tier, de_tier = (tier2, tier1) if re.search(r'[a-zA-Z]', tier1.get("TIER_ID")) is not None\
-                else (tier1, tier2)
-
-            aa_ru_all = ru_tier.findall('.//ALIGNABLE_ANNOTATION')
-            aa_de_all = de_tier.findall('.//ALIGNABLE_ANNOTATION')
-            idx = 0
-
-            while idx < min(len(aa_ru_all), len(aa_de_all)):
-                aa_ru, aa_de = aa_ru_all[idx], aa_de_all[idx]
-                start_ru = time_slots[aa_ru.get('TIME_SLOT_REF1')]
-                end_ru = time_slots[aa_ru.get('TIME_SLOT_REF2')]  # almost equal or equal for valid pairs
-                start_de = time_slots[aa_de.get('TIME_SLOT_REF1')]
-
-                # we pop empty intervals that have no pairs because they were added by mistake
-                if abs(int(start_ru) - int(start_de)) > 100:  # triggers if annotations are more than 10ms apart
-                    if int(start_de) < int(start_ru):  # empty intervals appear earlier than
-                        aa_de_all.pop(idx)
-                    else:
-                        aa_ru_all.pop(idx)
-                else:
-                    text_ru = aa_ru.find("ANNOTATION_VALUE").text
-                    text_de = aa_de.find("ANNOTATION_VALUE").text
-                    speech_slices[filename].append([start_ru, end_ru, str(text_ru), str(text_de)])
-                    idx += 1
-            tier_number += 2
-            # if len(aa_ru_all) != len(aa_de_all):
-            #     msg = ' '.join(["\nWarning! Tiers", tier1.get("TIER_ID"), "and", tier2.get("TIER_ID"), "in", efile,
-            #                     "have unequal lengths. Correct data before processing. "
-            #                     "Check ELAN file for blank intervals or other errors."])
-            #     raise ParseError(msg)
-
-        speech_slices[filename].sort(key=(lambda x: x[1]))  # orders speech for the whole efile chronologically;
-        for id_, list_ in enumerate(speech_slices[filename], start=1):
-            list_.append(id_)  # this adds a unique id to every list in ordered speech_slices
-    return speech_slices
-
-
-def main(efiles, videofiles, video_path):
+        print("Parsing ", efile, sep='')
+        speech_slices = list()
+
+        with metrics.stage("parse", filename):
+            for ru_tier, de_tier in elan.load(efile).speech_pairs(LINGUISTIC_TYPE_REF):
+                # empty intervals that have no pairs were added by mistake and are dropped
+                pairs, dropped = elan.align(ru_tier, de_tier, tolerance)
+                for aa_ru, aa_de in pairs:
+                    speech_slices.append([aa_ru.start, aa_ru.end, str(aa_ru.value), str(aa_de.value)])
+                if dropped:
+                    print("\t{} intervals with no pair in tiers {} and {} are ignored".format(
+                        len(dropped), ru_tier.tier_id, de_tier.tier_id))
+
+            speech_slices.sort(key=(lambda x: x[1]))  # orders speech for the whole efile chronologically;
+            for id_, list_ in enumerate(speech_slices, start=1):
+                list_.append(id_)  # this adds a unique id to every list in ordered speech_slices
+        yield filename, speech_slices
+
+
+def extract_speech(efiles, tolerance=elan.TOLERANCE):
+    """    Intervals of all ELAN files at once: {name of an ELAN file: its intervals}, see iter_speech()  """
+    return dict(iter_speech(efiles, tolerance))
+
+
+def parse_ahead(efiles, depth=PIPELINE_DEPTH):
+    """
+    Parses ELAN files in a background thread and yields them like iter_speech() does. At most `depth` parsed files
+      wait in the queue, so the next episode is being parsed while the current one is cut, without holding the
+      intervals of the whole season in memory.
+    If the consumer stops early (cutting failed, Ctrl-C) and closes the generator, the thread stops as well instead
+      of waiting forever for room in the queue.
+    """
+    parsed = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                parsed.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            for item in iter_speech(efiles):
+                if not put(item):
+                    return
+        except BaseException as error:  # handed over to the main thread
+            put(error)
+            return
+        put(None)
+
+    threading.Thread(target=producer, daemon=True).start()
+    try:
+        while True:
+            item = parsed.get()
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def valid_slices(filename, slices, duration):
+    """
+    Leaves out fragments that cannot be cut: empty or reversed intervals and intervals outside of the video (duration
+      in ms, None if unknown). They are listed on the screen, so that they can be corrected in ELAN.
+    """
+    result = list()
+    for slice_ in slices:
+        if slice_[0] < 0 or slice_[1] <= slice_[0] or (duration is not None and slice_[1] > duration):
+            print("Warning! Interval {}-{} ms ({}) does not fit into video {} of {} ms, it will not be cut.".format(
+                slice_[0], slice_[1], slice_[2], filename, duration))
+        else:
+            result.append(slice_)
+    return result
+
+
+def plan(efiles, videofiles, queue_dir, subtitles_mode="fragment", engine="slice", mode="burn"):
+    """
+    Writes subtitles and puts the ffmpeg commands for all fragments that are not up to date into a queue in queue_dir
+      (see the workqueue module) instead of running them. Workers on any machine that shares the filesystem then
+      cut the fragments, see worker(). Plan and workers must run in the same directory, where OUT and Subtitles are.
+    Fragments finished by workers of a previous plan are recorded in the manifest if they are still up to date, so
+      they are not planned again. The "auto" engine needs to run ffmpeg to choose and is not available here.
+    """
+    workqueue.create(queue_dir)
+    videofiles = {os.path.splitext(os.path.split(filename)[1])[0]: filename for filename in videofiles}
+    media.load_index()
+    manifest = load_manifest()
+    finished = dict()
+    for result in workqueue.results(queue_dir):
+        finished.update(result)
+    planned = 0
+    try:
+        for filename, slices in iter_speech(efiles):
+            if filename not in videofiles:
+                print("Warning! An ELAN file with no corresponding videofile, no video will be cut: ", filename)
+                continue
+            video = media.info(videofiles[filename])
+            slices = valid_slices(filename, slices, video["duration"])
+            with metrics.stage("subtitles", filename):
+                make_subtitles(filename, slices, "tracks" if mode == "copy" else subtitles_mode)
+            todo = episode_jobs(video["path"], filename, slices, manifest, subtitles_mode, mode, finished=finished)
+            for batch in plan_batches([t[0] for t in todo.values()]):
+                for command, outputs in schedule(video["path"], filename, batch, todo,
+                                                 "slice" if mode == "copy" else engine, subtitles_mode):
+                    workqueue.add(queue_dir, outputs[0][0], {"command": command, "outputs": outputs})
+                    planned += 1
+    finally:
+        save_manifest(manifest)
+        media.save_index()
+    print("{} jobs are waiting in {}".format(planned, queue_dir))
+    print_saved()
+
+
+def worker(queue_dir, lease=workqueue.LEASE):
+    """
+    Takes jobs planned by plan() from the queue one by one and runs them until every job is done or has failed.
+    Any number of workers may run on any number of machines. A worker renews its claim on a job while ffmpeg runs;
+      jobs of workers that stopped renewing them for `lease` seconds are taken over by others. A worker whose claim
+      was taken over meanwhile stops its ffmpeg and leaves the job and its output to the new holder.
+    """
+    name = "{}-{}".format(socket.gethostname(), os.getpid())
+    finished = failed = 0
+    while True:
+        remaining = workqueue.pending(queue_dir)
+        if not remaining:
+            break
+        claimed = False
+        for job_id in remaining:
+            if not workqueue.claim(queue_dir, job_id, name, lease):
+                continue
+            claimed = True
+            job = workqueue.read(queue_dir, job_id)
+            process, started = Popen(['/bin/sh', '-c', job["command"]], stdin=DEVNULL), time.perf_counter()
+            try:
+                renewed = time.time()
+                while process.poll() is None:
+                    time.sleep(POLL_INTERVAL)
+                    if time.time() - renewed > lease / 4:
+                        if not workqueue.renew(queue_dir, job_id, name):
+                            process.terminate()
+                            process.wait()
+                        renewed = time.time()
+            except BaseException:  # Ctrl-C: give the job back to the others
+                process.terminate()
+                process.wait()
+                workqueue.release(queue_dir, job_id, name)
+                raise
+            metrics.ffmpeg(job["command"], process.returncode, time.perf_counter() - started)
+            if not workqueue.renew(queue_dir, job_id, name):
+                # the output in OUT is being written by the new holder of the job, it must not be stored from here
+                print("\nJob {} was taken over by another worker".format(job_id))
+            elif workqueue.read(queue_dir, job_id) != job:
+                # plan() replaced the job while ffmpeg ran (see workqueue.add()), the new one is left to be done
+                print("\nJob {} was planned again meanwhile".format(job_id))
+                workqueue.release(queue_dir, job_id, name)
+            elif process.returncode == 0:
+                workqueue.complete(queue_dir, job_id, finish_outputs(job["outputs"], time.perf_counter() - started),
+                                   name)
+                finished += 1
+            else:
+                workqueue.fail(queue_dir, job_id, {"command": job["command"], "returncode": process.returncode,
+                                                   "worker": name}, name)
+                failed += 1
+            print("\r\t{} jobs done, {} failed".format(finished, failed), end='', flush=True)
+        if not claimed:  # the rest is held by other workers; wait for them or for their leases to run out
+            time.sleep(min(lease / 4, 5))
+    print("\nNo jobs left in", queue_dir)
+    print_saved()
+
+
+def main(efiles, videofiles, jobs=os.cpu_count(), subtitles_mode="fragment", engine="slice", mode="burn", only=None):
     """
     The script takes two arguments:
         1. The path to the directory with ELAN files
         2. The path to the directory with Videofiles
-    It creates .ass files used as subtitles for video fragments;
-    It creates a shell script (without a '#!/bin/bash' for safety reasons) with commands that cut the videofiles in
-      accordance with the data in ELAN files with corresponding names and hardcodes subtitiles into the picture;
+    It creates .ass files used as subtitles for video fragments, one per fragment or one per episode depending on
+      subtitles_mode (see make_subtitles());
+    It cuts the videofiles in accordance with the data in ELAN files with corresponding names and hardcodes
+      subtitiles into the picture. Up to `jobs` ffmpeg processes run at the same time (one per CPU by default);
     PLEASE Read documentation to this script in the Documentation directory.
+    Fragments that previous runs made from the same data (see fragment_key()) are not made again; the manifest in
+      OUT keeps track of them. For the engines that run ffmpeg see cut_episode().
+    In "copy" mode fragments are not re-encoded: they start at the closest keyframe and carry the lines as subtitle
+      tracks instead (see copy_command()), which is much faster and good enough for previews.
+    With only ({name of an ELAN file: set of ids of lines}, see cut()) just the given lines are cut. The subtitles
+      of the whole episode still hold all lines, so the fragments are the same as those of a run without only.
     """
-    speech_slices = extract_speech(efiles)
+    # each video is probed once and looked up by name from now on, see the media module
+    videofiles = {os.path.splitext(os.path.split(filename)[1])[0]: filename for filename in videofiles}
+    media.load_index()
+    manifest = load_manifest()
+    for leftover in [f for f in os.listdir("./OUT") if f.startswith(PARTIAL_PREFIX)]:
+        os.remove("./OUT/{}".format(leftover))  # fragments of an interrupted run
 
-    videofile_names = [os.path.splitext(os.path.split(filename)[1])[0] for filename in videofiles]
+    speech = parse_ahead(efiles)
+    try:
+        # ELAN files are parsed one after another while the previous episodes are being cut
+        for filename, slices in speech:
+            if filename in videofiles:
+                video = media.info(videofiles[filename])
+                slices = valid_slices(filename, slices, video["duration"])
+            ids = None if only is None else only.get(filename, set())
+            chosen = slices if ids is None else [slice_ for slice_ in slices if slice_[4] in ids]
+            if filename in videofiles and chosen != []:
+                print("Making subtitles for", filename, end='', flush=True)
+                with metrics.stage("subtitles", filename):
+                    if mode == "copy":
+                        make_subtitles(filename, slices, "tracks")
+                    else:  # one file per fragment is needed only for the fragments that are cut
+                        make_subtitles(filename, slices if subtitles_mode == "episode" else chosen, subtitles_mode)
+                print("\tDone!", flush=True)
+                print("Cutting down fragments for", filename, flush=True)
+                with metrics.stage("cut", filename):
+                    cut_episode(video["path"], filename, slices, manifest, jobs, subtitles_mode, engine, mode, ids)
+                save_manifest(manifest)  # a season takes long, progress should survive a crash
+                print("\tDone!", flush=True)
+            else:
+                print("Warning! An ELAN file with no corresponding videofile, no video will be cut: ", filename)
+        print_saved()
+    finally:
+        speech.close()  # stops the parsing thread if cutting failed
+        save_manifest(manifest)
+        media.save_index()
 
-    for filename, slices in speech_slices.items():
-        if filename in videofile_names and slices != []:
-            print("Making subtitles for", filename, end='', flush=True)
-            make_subtitles(filename, slices)
-            print("\tDone!", flush=True)
-            print("Cutting down fragments for", filename, flush=True)
-            for slice_ in slices:
-                cut_video(video_path, filename, slice_)
-            print("\tDone!", flush=True)
-        else:
-            print("Warning! An ELAN file with no corresponding videofile, no video will be cut: ", filename)
+
+def cut(efiles, videofiles, query=None, speaker=None, db_path=corpus.DB_PATH, jobs=os.cpu_count(),
+        subtitles_mode="fragment", engine="slice", mode="burn"):
+    """
+    Cuts only the lines found in the corpus database by a full-text query and/or a speaker, see corpus.search().
+      ELAN files that changed since they were indexed are indexed again first. Fragments are named and recorded in
+      the manifest as main() does it, so they are not cut again by a full run. In "episode" subtitles mode all lines
+      that overlap a found one are drawn, as in a full run.
+    """
+    corpus.index(efiles, db_path)
+    episodes = {os.path.splitext(os.path.split(efile)[1])[0]: efile for efile in efiles}
+    only = corpus.matching_lines(corpus.search(query, speaker, episodes, db_path))
+    print("{} lines in {} episodes match".format(sum(len(lines) for lines in only.values()), len(only)))
+    main([episodes[episode] for episode in sorted(only)], videofiles, jobs, subtitles_mode, engine, mode, only)
+
+
+def ssim(fragment, reference):
+    """    The SSIM of a fragment against another encode of it (1 means identical), measured by ffmpeg  """
+    output = check_output(['ffmpeg', '-i', fragment, '-i', reference, '-lavfi', 'ssim', '-f', 'null', '-'],
+                          stdin=DEVNULL, stderr=STDOUT).decode("utf-8", "replace")
+    match = re.search(r"SSIM .*All:(\d+(?:\.\d+)?)", output)
+    if match is None:
+        raise ParseError("Cannot measure the quality of {}".format(fragment))
+    return float(match.group(1))
+
+
+def tune_sample(efiles, videofiles, size, workdir):
+    """
+    Up to `size` lines spread evenly over the ELAN files given, as tuples (absolute path of the video, name of the
+      ELAN file, slice). Only videos in PROFILE_CONTAINERS are used. With no ELAN files the lines are made up and cut
+      out of a testsrc video made in workdir.
+    """
+    if not efiles:
+        from benchmarks import synthetic  # only needed here
+        synthetic.make_video(os.path.join(workdir, "tune.mp4"), size * 5 + 5)
+        return [(os.path.join(workdir, "tune.mp4"), "tune",
+                 [k * 5000, k * 5000 + 2500, "Проверка субтитров", "Untertitel-Test", k + 1]) for k in range(size)]
+    videofiles = {os.path.splitext(os.path.split(filename)[1])[0]: filename for filename in videofiles}
+    lines = list()
+    for filename, slices in iter_speech(efiles):
+        if filename in videofiles and os.path.splitext(videofiles[filename])[1].lower() in PROFILE_CONTAINERS:
+            video = media.info(videofiles[filename])
+            lines += [(os.path.abspath(video["path"]), filename, slice_)
+                      for slice_ in valid_slices(filename, slices, video["duration"])]
+    if not lines:
+        raise ParseError("No lines to cut: provide ELAN files and their {} videos.".format(
+            ', '.join(sorted(PROFILE_CONTAINERS))))
+    step = max(1, len(lines) // size)
+    return lines[::step][:size]
+
+
+def tune(efiles=None, videofiles=None, size=None, presets=TUNE_PRESETS, threads=None, concurrency=None,
+         min_ssim=MIN_SSIM, subtitles_mode="fragment", profile_path=ENCODE_PROFILE):
+    """
+    Finds the encode settings that make the most fragments per hour on this machine and writes them to profile_path,
+      which cut_command() and batch_command() read from then on. A sample of `size` lines (two per CPU by default,
+      see tune_sample()) is cut with every combination of an x264 preset, a number of -threads per ffmpeg and a
+      number of ffmpeg processes at once (by default as many as keep the CPUs busy: CPUs // threads). Settings that
+      make any fragment of the sample worse than min_ssim against a lossless encode of it are not chosen.
+    ffmpeg's defaults with one process per CPU are measured as well for comparison. Everything is cut in a temporary
+      directory. Returns the profile or None if no settings reach the quality floor.
+    """
+    cpus = os.cpu_count()
+    size = size or 2 * cpus
+    threads = threads or sorted({t for t in (1, 2, 4, cpus) if t <= cpus})
+    profile_path = os.path.abspath(profile_path)
+    directory, workdir = os.getcwd(), tempfile.mkdtemp(prefix="tune-")
+    results = list()
+    try:
+        media.load_index()
+        sample = tune_sample(efiles, videofiles, size, workdir)
+        media.save_index()
+        os.chdir(workdir)
+        mkdir("OUT")
+        mkdir("Subtitles")
+        for filename in {line[1] for line in sample}:
+            make_subtitles(filename, [line[2] for line in sample if line[1] == filename], subtitles_mode)
+
+        def cut_sample(options, jobs):
+            already_created.clear()  # the same fragments are cut again and again
+            made = [cut_command(video, filename, slice_, subtitles_mode, options) for video, filename, slice_ in sample]
+            wall = time.perf_counter()
+            run_commands([job[1] for job in made], jobs)
+            return [job[0] for job in made], time.perf_counter() - wall
+
+        extension = os.path.splitext(sample[0][0])[1]  # all of them are in PROFILE_CONTAINERS
+        print("Cutting {} sample fragments without loss for reference".format(len(sample)), flush=True)
+        for name in cut_sample(LOSSLESS, cpus)[0]:
+            os.replace("./OUT/{}{}".format(PARTIAL_PREFIX, name), "./OUT/reference-{}".format(name))
+
+        candidates = [(None, None, cpus)] + [(preset, t, jobs) for preset in presets for t in threads
+                                              for jobs in (concurrency or [max(1, cpus // t)])]
+        for preset, t, jobs in candidates:
+            profile = {"codec": "libx264", "preset": preset, "threads": t, "pix_fmt": "yuv420p"} if preset else None
+            print("preset {}, -threads {}, {} at once".format(preset or "default", t or "default", jobs), flush=True)
+            names, wall = cut_sample(profile_options(profile, extension), jobs)
+            quality = min(ssim("./OUT/{}{}".format(PARTIAL_PREFIX, name), "./OUT/reference-{}".format(name))
+                          for name in names)
+            results.append((preset, t, jobs, len(names) / wall * 3600, quality))
+            print("\t{:.0f} fragments per hour, SSIM at least {:.4f}".format(results[-1][3], quality), flush=True)
+    finally:
+        os.chdir(directory)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print("{:<10} {:>8} {:>7} {:>14} {:>8}".format("preset", "threads", "jobs", "fragments/h", "SSIM"))
+    for preset, t, jobs, rate, quality in results:
+        print("{:<10} {:>8} {:>7} {:>14.0f} {:>8.4f}{}".format(preset or "default", t or "default", jobs, rate, quality,
+                                                              '' if quality >= min_ssim else "  below the floor"))
+    passed = [result for result in results[1:] if result[4] >= min_ssim]
+    if not passed:
+        print("No settings reach SSIM {}, the encode profile is not changed".format(min_ssim))
+        return None
+    preset, t, jobs, rate, quality = max(passed, key=(lambda x: x[3]))
+    profile = {"codec": "libx264", "preset": preset, "threads": t, "pix_fmt": "yuv420p", "jobs": jobs,
+               "fragments_per_hour": round(rate), "ssim": quality, "min_ssim": min_ssim, "sample": len(sample),
+               "default_fragments_per_hour": round(results[0][3]), "tuned": time.strftime("%Y-%m-%d %H:%M:%S")}
+    with files.replacing(profile_path) as output:
+        json.dump(profile, output, indent=1)
+    print("Best: preset {}, -threads {}, {} at once, {:.0f} fragments per hour ({:.2f}x ffmpeg's defaults); written "
+          "to {}".format(preset, t, jobs, rate, rate / results[0][3], profile_path))
+    print("Fragments made with other settings will be cut again, their keys in the manifest change.")
+    return profile
+
+
+def input_files(elan_path, video_path):
+    """    Lists ELAN files and videos given either as two directories or as two files  """
+    if not os.path.exists(elan_path) or not os.path.exists(video_path):
+        raise ParseError("Provide correct paths.")
+    if os.path.isdir(elan_path) and os.path.isdir(video_path):
+        efiles = [file.path for file in os.scandir(elan_path) if os.path.splitext(file.path)[1] == ".eaf"]
+        videofiles = [file.path for file in os.scandir(video_path)]
+    elif os.path.isfile(elan_path) and os.path.isfile(video_path):
+        efiles = [os.path.relpath(elan_path)]
+        videofiles = [os.path.relpath(video_path)]
+    else:
+        raise ParseError("Provide either two files or two directories.")
+    return efiles, videofiles
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
+    argv = sys.argv[1:]
+    command = argv.pop(0) if argv and argv[0] in ("plan", "worker", "cut", "tune") else None
+    jobs = int(cli.pop_option(argv, "--jobs", load_profile().get("jobs", os.cpu_count())))
+    subtitles_mode = cli.pop_option(argv, "--subtitles", "fragment")
+    engine = cli.pop_option(argv, "--engine", "slice")
+    mode = cli.pop_option(argv, "--mode", "burn")
+    lease = float(cli.pop_option(argv, "--lease", workqueue.LEASE))
+    metrics_path = cli.pop_option(argv, "--metrics")
+    profile_path = cli.pop_option(argv, "--profile")
+    query = cli.pop_option(argv, "--query")
+    speaker = cli.pop_option(argv, "--speaker")
+    db_path = cli.pop_option(argv, "--db", corpus.DB_PATH)
+    sample = int(cli.pop_option(argv, "--sample", 0))
+    presets = cli.pop_option(argv, "--presets", ','.join(TUNE_PRESETS)).split(',')
+    threads = [int(t) for t in cli.pop_option(argv, "--threads", '').split(',') if t]
+    concurrency = [int(n) for n in cli.pop_option(argv, "--concurrency", '').split(',') if n]
+    min_ssim = float(cli.pop_option(argv, "--min-ssim", MIN_SSIM))
+    arguments = {None: (2,), "plan": (3,), "worker": (1,), "cut": (2,), "tune": (0, 2)}[command]
+    if len(argv) not in arguments or jobs < 1 or subtitles_mode not in SUBTITLE_MODES or engine not in ENGINES \
+            or mode not in MODES or (command == "plan" and engine == "auto") \
+            or (command == "cut" and query is None and speaker is None):
         raise ParseError("Provide arguments as follows:\n"
                          "$... process_video.py <Path to ELAN files directory> <Path to videos directory> \n OR \n"
-                         "$... process_video.py <Path to an ELAN file> <Path to a videofile>")
-    elif not os.path.exists(sys.argv[1]) or not os.path.exists(sys.argv[2]):
-        raise ParseError("Provide correct paths.")
+                         "$... process_video.py <Path to an ELAN file> <Path to a videofile>\n"
+                         "Options: --jobs N  number of ffmpeg processes to run at once (default: the encode profile\n"
+                         "           if there is one, see tune, or the number of CPUs)\n"
+                         "         --subtitles fragment|episode  one .ass file per fragment (default) or per episode\n"
+                         "         --engine slice|batch|auto  one ffmpeg per fragment (default), one per batch of close\n"
+                         "           fragments, or measure both on each episode and use the faster one\n"
+                         "         --mode burn|copy  re-encode with subtitles in the picture (default) or cut at\n"
+                         "           keyframes without re-encoding and add the subtitles as tracks\n"
+                         "         --metrics FILE  append timings of every stage and ffmpeg call to FILE (JSON lines)\n"
+                         "         --profile FILE  dump cProfile statistics of the Python stages to FILE\n"
+                         "To share the work between machines, plan it (same options except --jobs and --engine auto)\n"
+                         "$... process_video.py plan <ELAN path> <video path> <queue directory>\n"
+                         "and start any number of workers in the same directory on any machine:\n"
+                         "$... process_video.py worker <queue directory> [--lease SECONDS]\n"
+                         "To cut only the lines found in the corpus database (see corpus.py), with the same options\n"
+                         "$... process_video.py cut <ELAN path> <video path> --query <FTS5 query> and/or\n"
+                         "  --speaker TIER [--db FILE]\n"
+                         "To find the encode settings that cut the most fragments per hour on this machine (they are\n"
+                         "  written to {} and used from then on), on a sample of the lines or on a test video\n"
+                         "$... process_video.py tune [<ELAN path> <video path>] [--sample N] [--presets P1,P2,...]\n"
+                         "  [--threads T1,T2,...] [--concurrency N1,N2,...] [--min-ssim {}]".format(ENCODE_PROFILE,
+                                                                                                  MIN_SSIM))
 
-    if os.path.isdir(sys.argv[1]) and os.path.isdir(sys.argv[2]):
-        efiles = [file.path for file in os.scandir(sys.argv[1]) if os.path.splitext(file.path)[1] == ".eaf"]
-        videofiles = [file.path for file in os.scandir(sys.argv[2])]
-        video_path = sys.argv[2]
-    elif os.path.isfile(sys.argv[1]) and os.path.isfile(sys.argv[2]):
-        efiles = [os.path.relpath(sys.argv[1])]
-        videofiles = [os.path.relpath(sys.argv[2])]
-        video_path = os.path.split(os.path.relpath(sys.argv[2]))[0]  # get relative path to the file for formatting
-    else:
-        raise ParseError("Provide either two files or two directories.")
     mkdir("OUT")
     mkdir("Subtitles")
-
-    main(efiles, videofiles, video_path)
+    if metrics_path is not None or profile_path is not None:
+        metrics.start(metrics_path, profile_path)
+    try:
+        if command == "worker":
+            worker(argv[0], lease)
+        elif command == "cut":
+            cut(*input_files(argv[0], argv[1]), query, speaker, db_path, jobs, subtitles_mode, engine, mode)
+        elif command == "tune":
+            tune(*(input_files(argv[0], argv[1]) if argv else (None, None)), sample, presets, threads, concurrency,
+                 min_ssim, subtitles_mode)
+        elif command == "plan":
+            plan(*input_files(argv[0], argv[1]), argv[2], subtitles_mode, engine, mode)
+        else:
+            main(*input_files(argv[0], argv[1]), jobs, subtitles_mode, engine, mode)
+    finally:
+        metrics.finish()
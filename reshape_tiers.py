@@ -1,9 +1,18 @@
 import csv
 import os
+import shutil
 from subprocess import DEVNULL, check_call
-from sys import argv
+import sys
 from xml.etree import ElementTree as et
 
+from joblib import Parallel, delayed
+
+import cli
+
+# native etree header makes ELAN freeze due to the way encoding is written, so this one is written instead
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n '
+
+
 class ParseError(Exception):
     """    The Exception class to use in case something is incorrect  """
 
@@ -26,25 +35,31 @@ def extract_non_tier_elements(root):
     return before, after
 
 
-def extract_tier_elements(root):
-    utter, non_utter = [], []
-    meta = open(argv[2], 'r', newline='')
-    reader = csv.reader(meta)
-    for row in reader:
-        russian = root.find(f".//TIER[@TIER_ID='{row[0]}']")
-        german = root.find(f".//TIER[@TIER_ID='{row[1]}']")
-        if russian is None:
-            raise ParseError(f'Tier "{row[0]}" not found.')
-        elif german is None:
-            raise ParseError(f'Tier "{row[1]}" not found.')
-        russian.set("LINGUISTIC_TYPE_REF", 'utterance')
-        german.set("LINGUISTIC_TYPE_REF", 'utterance')
-        utter.extend([russian, german])
-    non_utter = list(set(root.findall('TIER')) - set(utter))
+def extract_tier_elements(root, metadata):
+    """
+    Splits tiers into the ones with utterances, in the order of the rows of the .csv file `metadata` (Russian tier,
+      German tier), and the rest, in the order they have in the file. Tiers are looked up by their ids in a dict
+      made once rather than by searching the tree for every row.
+    """
+    tiers = root.findall('TIER')
+    index = {tier.get("TIER_ID"): tier for tier in tiers}
+    utter = []
+    with open(metadata, 'r', newline='') as meta:
+        for row in csv.reader(meta):
+            russian, german = index.get(row[0]), index.get(row[1])
+            if russian is None:
+                raise ParseError(f'Tier "{row[0]}" not found.')
+            elif german is None:
+                raise ParseError(f'Tier "{row[1]}" not found.')
+            russian.set("LINGUISTIC_TYPE_REF", 'utterance')
+            german.set("LINGUISTIC_TYPE_REF", 'utterance')
+            utter.extend([russian, german])
+    chosen = set(utter)
+    non_utter = [tier for tier in tiers if tier not in chosen]
     return utter, non_utter
 
 
-def main(filename):
+def main(filename, metadata, output=None):
     """
     We need to reorder tiers with utterances in ELAN files to assure that corresponding tiers go in pairs and that
      German translations follow Russian text.
@@ -54,12 +69,13 @@ def main(filename):
             LINGUISTIC_TYPE to "utterance" for future parsing.
         4) The ones that are tiers without utterances(we add them to the very end)
         2) The ones that go after tiers
+    The result is written to output (the ELAN file itself by default) at once, header included.
     """
     tree = et.parse(filename)
     root = tree.getroot()
 
     before_tiers, after_tiers = extract_non_tier_elements(root)
-    utterance_tiers, non_utterance_tiers = extract_tier_elements(root)
+    utterance_tiers, non_utterance_tiers = extract_tier_elements(root, metadata)
 
     new_type = et.Element('LINGUISTIC_TYPE')
     new_type.set('GRAPHIC_REFERENCES', "false")
@@ -71,29 +87,67 @@ def main(filename):
     for tier in root.findall('*'):
         root.remove(tier)
     root.extend(before_tiers + utterance_tiers + non_utterance_tiers + after_tiers)
-    tree.write(argv[1], encoding='UTF-8', method='xml')
 
-    # native etree header makes ELAN freeze due to the way encoding is written
-    with open(argv[1], mode='r+') as efile:
-        content = efile.read()
-        efile.seek(0, 0)
-        efile.write('<?xml version="1.0" encoding="UTF-8"?>\n ' + content)
+    with open(output or filename, 'wb') as efile:
+        efile.write(XML_HEADER.encode('UTF-8'))
+        tree.write(efile, encoding='UTF-8', method='xml')
+
+
+def reshape(filename, metadata):
+    """    Keeps a copy of an ELAN file as <name>_backup.eaf and reorders its tiers, see main()  """
+    splitname = os.path.splitext(filename)
+    shutil.copyfile(filename, splitname[0] + "_backup" + splitname[1])
+    main(filename, metadata)
+
+
+def reshape_safely(filename, metadata):
+    """    reshape() for a worker process: returns the error message instead of stopping the whole batch  """
+    try:
+        reshape(filename, metadata)
+    except (ParseError, et.ParseError, OSError, IndexError) as error:
+        return "{}: {}".format(filename, error)
+    return None
+
+
+def batch(elan_dir, metadata_dir, jobs=os.cpu_count()):
+    """
+    Reshapes every ELAN file in elan_dir that has a .csv file with the same name in metadata_dir, `jobs` files at a
+      time in worker processes. Backups (<name>_backup.eaf) are skipped. Returns the number of files that failed.
+    """
+    pairs = list()
+    for file in sorted(os.scandir(elan_dir), key=(lambda x: x.name)):
+        name, extension = os.path.splitext(file.name)
+        if extension != ".eaf" or name.endswith("_backup"):
+            continue
+        metadata = os.path.join(metadata_dir, name + ".csv")
+        if os.path.exists(metadata):
+            pairs.append((file.path, metadata))
+        else:
+            print("No metadata for", file.path)
+    if not pairs:
+        raise ParseError("No ELAN files with metadata found")
+
+    errors = [error for error in Parallel(n_jobs=min(jobs, len(pairs)))(
+        delayed(reshape_safely)(efile, metadata) for efile, metadata in pairs) if error is not None]
+    for error in errors:
+        print("Error!", error)
+    print("{} of {} files reshaped".format(len(pairs) - len(errors), len(pairs)))
+    return len(errors)
 
 
 if __name__ == '__main__':
-    if len(argv) < 2:
-        print("Provide an ELAN file to reorder.")
+    argv = sys.argv[1:]
+    jobs = int(cli.pop_option(argv, "--jobs", os.cpu_count()))
+    if len(argv) < 2 or jobs < 1:
+        print("Provide an ELAN file to reorder and a .csv file with metadata, or a directory with ELAN files and a "
+              "directory with .csv files of the same names. Option: --jobs N  files to reorder at once")
         exit()
-    elif os.path.exists(argv[1]) and os.path.splitext(argv[1])[1] == '.eaf'\
-            and os.path.exists(argv[2]) and os.path.splitext(argv[2])[1] == '.csv':
-        splitargv = os.path.splitext(argv[1])
-        backup_file = splitargv[0] + "_backup" + splitargv[1]
-
-        print(open(argv[1]).read(),
-              file=open(backup_file, mode='w'))
-        main(argv[1])
-    elif os.path.exists(argv[1]) is False or os.path.splitext(argv[1])[1] == '.eaf' is False:
+    elif os.path.isdir(argv[0]) and os.path.isdir(argv[1]):
+        sys.exit(1 if batch(argv[0], argv[1], jobs) else 0)
+    elif os.path.exists(argv[0]) and os.path.splitext(argv[0])[1] == '.eaf'\
+            and os.path.exists(argv[1]) and os.path.splitext(argv[1])[1] == '.csv':
+        reshape(argv[0], argv[1])
+    elif os.path.exists(argv[0]) is False or os.path.splitext(argv[0])[1] != '.eaf':
         print("ELAN file does not exist and/or is not .eaf-formatted. Provide a valid ELAN file.")
     else:
         print("Metadata file does not exist and/or is not .csv-formatted. Provide a valid .csv file with metadata.")
-
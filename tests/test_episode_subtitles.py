@@ -0,0 +1,70 @@
+import shutil
+from subprocess import DEVNULL, check_call, check_output
+
+import pytest
+
+import process_video
+
+# Subtitles of the whole episode (--subtitles episode) must appear in a fragment at the same moments as in the source
+#  video, although the fragment is cut with fast seeking and starts from zero. A testsrc clip is cut with and without
+#  subtitles and the bottom of the picture, where the lines are drawn, is compared around the times of a line.
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+
+VIDEO = "clip.mp4"  # the argument of cut_video()
+WIDTH, HEIGHT = 320, 240
+# the fragment that is cut (with no line of its own) and a line within it, from 2 s to 4 s of the clip
+FRAGMENT = [1000, 5000, '', '', 1]
+LINE = [2000, 4000, "ЖЖЖЖЖЖЖЖ", "WWWWWWWW", 2]
+
+
+def bottom(video, seconds):
+    """    The lower quarter of a frame of a video as raw grey pixels  """
+    frame = check_output(['ffmpeg', '-ss', str(seconds), '-i', video, '-frames:v', '1', '-f', 'rawvideo',
+                          '-pix_fmt', 'gray', '-loglevel', 'error', '-'], stdin=DEVNULL)
+    return frame[WIDTH * HEIGHT * 3 // 4:WIDTH * HEIGHT]
+
+
+def difference(video1, seconds1, video2, seconds2):
+    """    Mean absolute difference of the bottoms of two frames, close to 0 if they show the same  """
+    part1, part2 = bottom(video1, seconds1), bottom(video2, seconds2)
+    assert len(part1) == len(part2) == WIDTH * HEIGHT // 4
+    return sum(abs(a - b) for a, b in zip(part1, part2)) / len(part1)
+
+
+def cut(slice_, subtitles_mode):
+    process_video.already_created.clear()
+    process_video.make_subtitles("clip", [LINE], subtitles_mode)  # the fragment itself has no line to draw
+    process_video.cut_video(VIDEO, "clip", slice_, subtitles_mode)
+    return "./OUT/clip-{}-{}-{}.mp4".format(slice_[0], slice_[1], slice_[4])
+
+
+@pytest.fixture(scope="module")
+def fragments(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("clip")
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(directory)
+        process_video.mkdir("OUT")
+        process_video.mkdir("Subtitles")
+        check_call(['ffmpeg', '-f', 'lavfi', '-i', 'testsrc=duration=6:size={}x{}:rate=25'.format(WIDTH, HEIGHT),
+                    '-c:v', 'libx264', '-pix_fmt', 'yuv420p', 'clip.mp4', '-y', '-loglevel', '24'], stdin=DEVNULL)
+        check_call(['ffmpeg', '-ss', '1', '-i', 'clip.mp4', '-t', '4', 'plain.mp4', '-y', '-loglevel', '24'],
+                   stdin=DEVNULL)
+        yield {"plain": str(directory / "plain.mp4"), "episode": str(directory / cut(FRAGMENT, "episode")),
+               "fragment": str(directory / cut(LINE, "fragment"))}
+
+
+def test_no_subtitles_outside_the_line(fragments):
+    # 0.5 s and 3.5 s into the fragment are 1.5 s and 4.5 s of the clip, before and after the line
+    for seconds in (0.5, 3.5):
+        assert difference(fragments["episode"], seconds, fragments["plain"], seconds) < 3
+
+
+def test_subtitles_during_the_line(fragments):
+    for seconds in (1.2, 2.0, 2.8):
+        assert difference(fragments["episode"], seconds, fragments["plain"], seconds) > 5
+
+
+def test_same_picture_as_fragment_mode(fragments):
+    # the fragment of the line alone starts at 2 s of the clip, 1 s later than the one of the episode mode
+    for seconds in (0.5, 1.5):
+        assert difference(fragments["episode"], seconds + 1, fragments["fragment"], seconds) < 3
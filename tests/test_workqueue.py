@@ -0,0 +1,50 @@
+import os
+import sys
+import time
+from subprocess import DEVNULL, Popen
+
+import workqueue
+
+# Workers of process_video.py share a queue directory and must do every job exactly once, also when one of the jobs
+#  is held by a worker that crashed long ago. The jobs here only append their id to a file instead of running ffmpeg.
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "process_video.py")
+JOBS = ["job-{:02}".format(k) for k in range(24)]
+WORKERS = 3
+
+
+def add_jobs(queue_dir):
+    workqueue.create(queue_dir)
+    for job_id in JOBS:
+        workqueue.add(queue_dir, job_id, {"command": "sleep 0.05; echo {} >> runs.txt".format(job_id), "outputs": []})
+
+
+def test_every_job_is_done_once(tmp_path):
+    queue_dir = str(tmp_path / "queue")
+    add_jobs(queue_dir)
+    # a claim of a crashed worker that has not been renewed for an hour
+    stale = os.path.join(queue_dir, "claims", JOBS[0])
+    with open(stale, 'w', encoding="utf-8") as lock:
+        lock.write("crashed-worker")
+    os.utime(stale, (time.time() - 3600, time.time() - 3600))
+
+    workers = [Popen([sys.executable, SCRIPT, "worker", queue_dir, "--lease", "60"], cwd=str(tmp_path),
+                     stdin=DEVNULL, stdout=DEVNULL) for _ in range(WORKERS)]
+    for process in workers:
+        assert process.wait(timeout=120) == 0
+
+    with open(str(tmp_path / "runs.txt"), encoding="utf-8") as runs:
+        assert sorted(runs.read().split()) == JOBS
+    assert sorted(workqueue.ids(queue_dir, "done")) == JOBS
+    assert workqueue.ids(queue_dir, "failed") == set()
+    assert os.listdir(os.path.join(queue_dir, "claims")) == []
+
+
+def test_a_job_added_again_is_pending_again(tmp_path):
+    queue_dir = str(tmp_path / "queue")
+    add_jobs(queue_dir)
+    workqueue.complete(queue_dir, JOBS[0], {})
+    workqueue.fail(queue_dir, JOBS[1], {})
+    assert JOBS[0] not in workqueue.pending(queue_dir) and JOBS[1] not in workqueue.pending(queue_dir)
+    for job_id in JOBS[:2]:
+        workqueue.add(queue_dir, job_id, {"command": "true", "outputs": []})
+    assert workqueue.pending(queue_dir) == JOBS
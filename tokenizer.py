@@ -0,0 +1,57 @@
+from functools import lru_cache
+import re
+
+# Tokenizers for the .vrt files of make_vrt.py, chosen by name (see get()):
+#   "regex"  the default: a compiled regular expression for Russian and German lines, no dependencies, no start-up
+#   "nltk"   nltk.word_tokenize, imported only when it is asked for; it needs the NLTK punkt data to be installed
+#  Both split punctuation off words and turn straight double quotes into `` and '' as NLTK does. The regex tokenizer
+#  also separates "…" and does not know abbreviations besides ones like "z.B." and "т.е."; see benchmarks/tokenizer.py
+#  for how often the two agree. The module is not called "tokenize", which is a module of the standard library.
+CACHE_SIZE = 65536  # distinct lines remembered per process; short lines such as "Да." and "Ja." repeat a lot
+
+TOKEN_REGEX = re.compile(r"""
+    (?:\w\.){2,}                           # abbreviations: z.B., u.a., т.е., т.д.
+    | \d+(?:[.,:]\d+)+                     # numbers and times: 1.000, 3,5, 10:30
+    | \w+(?:-\w+)*                         # words, also hyphenated ones: Ost-West, кто-нибудь
+    | '(?:[sSmMdD]|ll|LL|re|RE|ve|VE)\b    # clitics as NLTK splits them: geht's -> geht 's
+    | \.{2,} | -{2,}                       # ... and --
+    | [^\w\s]                              # any other single symbol
+    """, re.VERBOSE)
+OPENING = set(" \t\n([{<«„")  # a straight double quote after these (or first in a line) opens a quotation
+
+_instances = dict()  # {(name, cache_size): tokenizer}, so that a process keeps one cache per tokenizer
+
+
+def regex_tokenize(text):
+    if '"' not in text:
+        return TOKEN_REGEX.findall(text)
+    tokens = list()
+    for match in TOKEN_REGEX.finditer(text):
+        token = match.group()
+        if token == '"':
+            token = "``" if match.start() == 0 or text[match.start() - 1] in OPENING else "''"
+        tokens.append(token)
+    return tokens
+
+
+def nltk_tokenize(text):
+    from nltk import word_tokenize  # slow to import, so only when this tokenizer is chosen
+    return word_tokenize(text)
+
+
+TOKENIZERS = {"regex": regex_tokenize, "nltk": nltk_tokenize}
+
+
+def get(name="regex", cache_size=CACHE_SIZE):
+    """
+    Returns the tokenizer with a given name: a function from a line to a sequence of tokens. Results for the last
+      cache_size distinct lines are remembered (set it to 0 to remember nothing) for as long as the process runs.
+    """
+    if name not in TOKENIZERS:
+        raise ValueError("Unknown tokenizer {}, choose one of: {}".format(name, ', '.join(sorted(TOKENIZERS))))
+    if cache_size == 0:
+        return TOKENIZERS[name]
+    if (name, cache_size) not in _instances:
+        tokenize = TOKENIZERS[name]
+        _instances[name, cache_size] = lru_cache(maxsize=cache_size)(lambda text: tuple(tokenize(text)))
+    return _instances[name, cache_size]
@@ -0,0 +1,146 @@
+import json
+import os
+import time
+
+import files
+
+# A queue of jobs in a directory on a filesystem shared by several machines. Nothing but files is used, because
+#  locks of databases are unreliable on network filesystems:
+#   <queue>/jobs/<id>.json    a job as written by add()
+#   <queue>/claims/<id>       exists while a worker holds the job; created atomically (O_EXCL), its modification
+#                             time is the last sign of life of the worker (renew())
+#   <queue>/done/<id>.json    the result of a finished job
+#   <queue>/failed/<id>.json  the error of a failed job; failed jobs are not retried until the file is deleted or
+#                             the job is added again
+# A claim that has not been renewed for `lease` seconds belongs to a crashed worker and may be taken over. Clocks of
+#  the machines are supposed to be synchronised (e.g. by NTP).
+LEASE = 600  # seconds
+SECTIONS = ("jobs", "claims", "done", "failed")
+
+
+def create(queue_dir):
+    for section in SECTIONS:
+        os.makedirs(os.path.join(queue_dir, section), exist_ok=True)
+
+
+def write_json(path, data):
+    """    Writes a file under a temporary name first, so that nobody ever reads half of it, see files.replacing()  """
+    with files.replacing(path) as output:
+        json.dump(data, output, ensure_ascii=False)
+
+
+def read_json(path):
+    with open(path, encoding="utf-8") as source:
+        return json.load(source)
+
+
+def ids(queue_dir, section):
+    return {os.path.splitext(name)[0] for name in os.listdir(os.path.join(queue_dir, section))
+            if not name.endswith(".tmp")}
+
+
+def add(queue_dir, job_id, job):
+    """
+    Puts a job into the queue. A job that is added again, e.g. because its fragment changed, has to be done again:
+      the result or the error of the job it replaces is removed.
+    """
+    write_json(os.path.join(queue_dir, "jobs", job_id + ".json"), job)
+    for section in ("done", "failed"):
+        try:
+            os.remove(os.path.join(queue_dir, section, job_id + ".json"))
+        except FileNotFoundError:
+            pass
+
+
+def read(queue_dir, job_id):
+    return read_json(os.path.join(queue_dir, "jobs", job_id + ".json"))
+
+
+def pending(queue_dir):
+    """    Ids of jobs that are neither done nor failed, in a stable order  """
+    return sorted(ids(queue_dir, "jobs") - ids(queue_dir, "done") - ids(queue_dir, "failed"))
+
+
+def results(queue_dir):
+    """    Results of all finished jobs  """
+    return [read_json(os.path.join(queue_dir, "done", job_id + ".json")) for job_id in sorted(ids(queue_dir, "done"))]
+
+
+def owner(queue_dir, job_id):
+    """    The name of the worker that holds a job, None if nobody does  """
+    try:
+        with open(os.path.join(queue_dir, "claims", job_id), encoding="utf-8") as lock:
+            return lock.read()
+    except FileNotFoundError:
+        return None
+
+
+def claim(queue_dir, job_id, worker, lease=LEASE):
+    """
+    Tries to take a job for a worker. Returns True if the job is now held by the worker and still has to be done.
+    """
+    path = os.path.join(queue_dir, "claims", job_id)
+    try:
+        if time.time() - os.stat(path).st_mtime > lease:
+            # renaming is atomic: of several workers that find the same stale claim only one succeeds
+            stale = "{}.stale-{}".format(path, worker)
+            os.rename(path, stale)
+            if time.time() - os.stat(stale).st_mtime <= lease:
+                # another worker took the stale claim over between our stat() and rename(), and this is its fresh
+                #  claim: it goes back, unless yet another claim has been made in the meantime
+                try:
+                    os.link(stale, path)
+                except FileExistsError:
+                    pass
+                os.remove(stale)
+                return False
+            os.remove(stale)
+            print("Taking over job {} from a worker that stopped responding".format(job_id))
+    except FileNotFoundError:
+        pass
+    try:
+        descriptor = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(descriptor, 'w', encoding="utf-8") as lock:
+        lock.write(worker)
+    if owner(queue_dir, job_id) != worker:  # the claim was replaced right after it was made
+        return False
+    if os.path.exists(os.path.join(queue_dir, "done", job_id + ".json")):  # finished while we were looking
+        release(queue_dir, job_id, worker)
+        return False
+    return True
+
+
+def renew(queue_dir, job_id, worker=None):
+    """
+    Shows that the worker holding a job is alive. Returns False if the job is no longer held by the worker (its
+      claim was taken over after it had not been renewed in time); the worker should stop working on it then.
+    """
+    if worker is not None and owner(queue_dir, job_id) != worker:
+        return False
+    try:
+        os.utime(os.path.join(queue_dir, "claims", job_id))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def release(queue_dir, job_id, worker=None):
+    """    Gives a job back. With worker given, the claim is only removed if it is still that worker's  """
+    if worker is not None and owner(queue_dir, job_id) != worker:
+        return
+    try:
+        os.remove(os.path.join(queue_dir, "claims", job_id))
+    except FileNotFoundError:
+        pass
+
+
+def complete(queue_dir, job_id, result, worker=None):
+    write_json(os.path.join(queue_dir, "done", job_id + ".json"), result)
+    release(queue_dir, job_id, worker)
+
+
+def fail(queue_dir, job_id, error, worker=None):
+    write_json(os.path.join(queue_dir, "failed", job_id + ".json"), error)
+    release(queue_dir, job_id, worker)